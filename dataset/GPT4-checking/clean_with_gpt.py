@@ -1,46 +1,255 @@
-import openai, json
+import os, json, time, random, asyncio, hashlib
+import aiohttp
 import pandas as pd
 from tqdm import tqdm
+from prefilter import classify, agrees, report
+from html_extract import extract_pages, format_stats, TOKEN_BUDGET
 
-openai.api_key = None # fill in your API key
-assert openai.api_key is not None, "You must provide an API key"
+# Cleans the Singer / Bonafide Or Spoof / Model columns of a csv with GPT-4.
+# Rows are sent concurrently (at most `concurrency` requests in flight) through a token bucket that
+# keeps both requests and tokens per minute under the account limits. Every response is appended to
+# an on-disk cache keyed by hash(url, prompt version), and the cleaned csv is checkpointed every
+# `checkpoint_every` rows, so an interrupted run can be restarted without repeating any API call.
+
+api_key = None # fill in your API key
+assert api_key is not None, "You must provide an API key"
 systemPrompt = open('systemPrompt.txt', 'r').read().strip()
 csv_path = None # fill in the path to the csv file you want to clean
 assert csv_path is not None, "You must provide the path to the csv file you want to clean"
+cleaned_csv_path = csv_path.replace(".csv", "") + "_cleaned.csv" # checkpoints and final result go here
+html_folder = None # fill in the folder of saved video pages, named by html_extract.page_name(url)
+assert html_folder is not None, "You must provide the folder of saved HTML pages"
+token_budget = TOKEN_BUDGET # tokens of page content per request
 
-csv_file = pd.read_csv(csv_path)
+endpoint = "https://api.openai.com/v1" # any OpenAI-compatible server, e.g. a local stand-in for testing
+model = "gpt-4"
+concurrency = 8 # requests in flight
+requests_per_minute = 200
+tokens_per_minute = 40000
+max_retries = 6
+checkpoint_every = 50 # rows
+cache_path = "gpt_cache.jsonl"
+use_prefilter = True # resolve unambiguous rows locally, see prefilter.py
+agreement_sample = 0.05 # fraction of resolved rows also sent to the LLM to measure agreement
 
-for i in tqdm(range(len(csv_file)), desc="Cleaning"):
-    # get url
-    url = csv_file.iloc[i]['Url'].strip()
-    singer_name = csv_file.iloc[i]['Singer']
-    title = csv_file.iloc[i]['Title'].strip()
+# changing the model or the system prompt invalidates the cached responses
+PROMPT_VERSION = hashlib.blake2b((model + "\n" + systemPrompt).encode("utf-8"), digest_size=8).hexdigest()
+RESPONSE_FIELDS = ("type", "singer", "model", "correct")
+
+
+def cache_key(url):
+    return hashlib.blake2b((url + "\n" + PROMPT_VERSION).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def valid_response(response_json):
+    return isinstance(response_json, dict) and all(field in response_json for field in RESPONSE_FIELDS)
+
+
+def retry_delay(retry_after, attempt):
+    # Retry-After in seconds; an HTTP date (or no header) falls back to exponential backoff
     try:
-        HTMLContent = None # Implement HTMLContent.
-        assert HTMLContent is not None, "You must provide an HTML content. This part of the script need to be implemented by yourself."
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return 2 ** attempt + random.random()
+
+
+def load_cache(path):
+    cache = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interruption
+                    continue
+                if valid_response(entry.get("response")):
+                    # malformed answers cached by older runs are asked again
+                    cache[entry["key"]] = entry["response"]
+    return cache
+
+
+class TokenBucket:
+    """
+    Refills `rate` units per second up to `capacity`; acquire() waits until enough units are available.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) / self.rate)
+
+
+page_fields = {} # url -> compact JSON of title, description, uploader and tags, filled in by main()
+
+def get_html_content(url, singer_name, title):
+    # only the extracted fields are sent, not the page; rows without a saved page fall back to the title
+    HTMLContent = page_fields.get(url) or json.dumps({"title": title}, ensure_ascii=False)
+    return HTMLContent + "\nsinger_name: " + str(singer_name)
+
+
+def estimate_tokens(messages):
+    # ~4 characters per token, plus the expected answer
+    return sum(len(m["content"]) for m in messages) // 4 + 100
 
-        response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[
+
+class Cleaner:
+    def __init__(self, session):
+        self.session = session
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 60))
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 6)
+        self.cache = load_cache(cache_path)
+        self.cache_file = open(cache_path, "a")
+        self.api_calls = 0
+        self.resolved = 0
+        self.agreements = []
+
+    def close(self):
+        self.cache_file.close()
+
+    async def complete(self, messages):
+        headers = {"Authorization": f"Bearer {api_key}"}
+        payload = {"model": model, "messages": messages}
+        for attempt in range(max_retries):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimate_tokens(messages))
+            self.api_calls += 1
+            async with self.session.post(endpoint.rstrip("/") + "/chat/completions", json=payload, headers=headers) as r:
+                if r.status == 429 or r.status >= 500:
+                    await asyncio.sleep(retry_delay(r.headers.get("Retry-After"), attempt))
+                    continue
+                r.raise_for_status()
+                response = await r.json()
+            return response['choices'][0]['message']['content']
+        raise RuntimeError(f"gave up after {max_retries} attempts")
+
+    async def clean(self, url, singer_name, title):
+        key = cache_key(url)
+        if key in self.cache:
+            return self.cache[key]
+        async with self.semaphore:
+            messages = [
                 {"role": "system", "content": systemPrompt},
-                {"role": "user", "content": HTMLContent},
+                {"role": "user", "content": get_html_content(url, singer_name, title)},
             ]
-        )
+            content = await self.complete(messages)
         # get response text
-        response_json = json.loads(response['choices'][0]['message']['content'])
+        response_json = json.loads(content)
+        if not valid_response(response_json):
+            # not cached, so a re-run asks again
+            raise ValueError("malformed answer: " + content[:200])
+        self.cache[key] = response_json
+        self.cache_file.write(json.dumps({"key": key, "url": url, "prompt_version": PROMPT_VERSION,
+                                          "response": response_json}) + "\n")
+        self.cache_file.flush()
+        return response_json
+
+
+def checkpoint(csv_file):
+    tmp_path = cleaned_csv_path + ".tmp"
+    csv_file.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, cleaned_csv_path)
+
+
+def prefilter_row(url, title, singer_name):
+    """
+    Returns (rule-based answer or None, whether the row goes to the LLM).
+    """
+    response_json = classify(title, singer_name) if use_prefilter else None
+    # resolved rows in the agreement sample go to the LLM as well; the sample is picked by url,
+    # so a re-run checks the same rows (from the cache)
+    sampled = response_json is not None and int(cache_key(url), 16) % 10000 < agreement_sample * 10000
+    return response_json, response_json is None or sampled
+
 
+async def clean_row(cleaner, csv_file, i):
+    if pd.isna(csv_file.at[i, 'Url']) or pd.isna(csv_file.at[i, 'Title']):
+        print("Skipping row {}: no Url or Title".format(i))
+        return
+    # get url
+    url = csv_file.at[i, 'Url'].strip()
+    singer_name = csv_file.at[i, 'Singer']
+    title = csv_file.at[i, 'Title'].strip()
+    response_json, ask_llm = prefilter_row(url, title, singer_name)
+    if response_json is not None:
+        cleaner.resolved += 1
+    if ask_llm:
+        try:
+            llm_json = await cleaner.clean(url, singer_name, title)
+            if response_json is None:
+                response_json = llm_json
+            else:
+                cleaner.agreements.append(agrees(response_json, llm_json))
+        except Exception as e:
+            print(title, e)
+            if response_json is None:
+                return
+
+    try:
         cleaned_spoof_tag = response_json["type"]
         cleaned_singer_tag = response_json["singer"]
         cleaned_model_tag = response_json["model"]
         cleaned_correctness = str(response_json["correct"])
-
-        
-        csv_file.iloc[i]['Bonafide Or Spoof'] = cleaned_spoof_tag
-        csv_file.iloc[i]['Singer'] = cleaned_singer_tag
-        csv_file.iloc[i]['Model'] = cleaned_model_tag
-        if cleaned_correctness.strip().lower() != "true":
-            print("WARNING: Correctness is not True at {}".format(csv_file.iloc[i]['Url']))
-            print("Singer wrote as {}, but should be {}".format(singer_name, cleaned_singer_tag))
     except Exception as e:
         print(title, e)
-        continue
\ No newline at end of file
+        return
+
+    csv_file.at[i, 'Bonafide Or Spoof'] = cleaned_spoof_tag
+    csv_file.at[i, 'Singer'] = cleaned_singer_tag
+    csv_file.at[i, 'Model'] = cleaned_model_tag
+    if cleaned_correctness.strip().lower() != "true":
+        print("WARNING: Correctness is not True at {}".format(url))
+        print("Singer wrote as {}, but should be {}".format(singer_name, cleaned_singer_tag))
+
+
+async def main():
+    csv_file = pd.read_csv(csv_path, dtype=str)
+    # pages are only parsed for rows that go to the LLM and are not answered from the cache yet
+    cached = load_cache(cache_path)
+    pending = []
+    for i in csv_file.index:
+        if pd.isna(csv_file.at[i, 'Url']) or pd.isna(csv_file.at[i, 'Title']):
+            continue
+        url = csv_file.at[i, 'Url'].strip()
+        if cache_key(url) in cached:
+            continue
+        if prefilter_row(url, csv_file.at[i, 'Title'].strip(), csv_file.at[i, 'Singer'])[1]:
+            pending.append(url)
+    if len(pending) > 0:
+        extracted, stats = extract_pages(pending, html_folder, token_budget)
+        page_fields.update(extracted)
+        print(format_stats(stats))
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300)) as session:
+        cleaner = Cleaner(session)
+        tasks = [asyncio.create_task(clean_row(cleaner, csv_file, i)) for i in csv_file.index]
+        try:
+            for n, task in enumerate(tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Cleaning"), 1):
+                await task
+                if n % checkpoint_every == 0:
+                    checkpoint(csv_file)
+        finally:
+            for task in tasks:
+                task.cancel()
+            checkpoint(csv_file)
+            cleaner.close()
+    print(f"{cleaner.api_calls} API calls, {len(cleaner.cache)} cached responses, saved to {cleaned_csv_path}")
+    if use_prefilter:
+        print(report(cleaner.resolved, len(csv_file), cleaner.agreements))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
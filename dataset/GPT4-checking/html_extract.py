@@ -0,0 +1,178 @@
+import os, re, json, html, hashlib
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+
+# Shrinks a locally saved video page to the fields clean_with_gpt.py needs: title, description,
+# uploader and tags, as one compact JSON string under a token budget. Pages are expected under
+# html_folder as <page_name(url)>.html; pages are parsed in a process pool.
+
+TOKEN_BUDGET = 512 # tokens per page, the description is shortened first
+CHARS_PER_TOKEN = 4 # same estimate as clean_with_gpt.estimate_tokens
+
+
+def page_name(url):
+    return hashlib.blake2b(url.strip().encode("utf-8"), digest_size=16).hexdigest()
+
+
+def page_path(url, html_folder):
+    return os.path.join(html_folder, page_name(url) + ".html")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", html.unescape(str(text))).strip()
+
+
+class _MetaParser(HTMLParser):
+    """
+    Collects <title>, <meta name/property/itemprop=... content=...> and <link itemprop=name> (the
+    uploader in YouTube's author block). Stops caring about the body once it has seen it.
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.tags = []
+        self.title = ""
+        self.in_title = False
+        self.in_author = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "title":
+            self.in_title = True
+        elif tag == "meta" and attrs.get("content"):
+            key = (attrs.get("property") or attrs.get("name") or attrs.get("itemprop") or "").lower()
+            if key in ("og:video:tag", "video:tag"):
+                self.tags.append(attrs["content"])
+            elif key and key not in self.meta:
+                self.meta[key] = attrs["content"]
+        elif tag == "span" and attrs.get("itemprop") == "author":
+            self.in_author += 1
+        elif tag == "link" and self.in_author and attrs.get("itemprop") == "name" and attrs.get("content"):
+            self.meta.setdefault("uploader", attrs["content"])
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag == "span" and self.in_author:
+            self.in_author -= 1
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+
+
+# the full description and channel name are only in the embedded player JSON on YouTube
+_JSON_FIELDS = {
+    "description": re.compile(r'"shortDescription":"((?:[^"\\]|\\.)*)"'),
+    "uploader": re.compile(r'"ownerChannelName":"((?:[^"\\]|\\.)*)"'),
+    "keywords": re.compile(r'"keywords":(\[(?:[^\]"\\]|"(?:[^"\\]|\\.)*")*\])'),
+}
+
+
+def _json_field(page, name):
+    match = _JSON_FIELDS[name].search(page)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1) if name == "keywords" else '"' + match.group(1) + '"')
+    except json.JSONDecodeError:
+        return None
+
+
+def extract_fields(page):
+    parser = _MetaParser()
+    # everything the parser needs is in <head> and the first part of <body>
+    head_end = page.find("</head>")
+    parser.feed(page if head_end < 0 else page[:head_end + 200000])
+    meta = parser.meta
+
+    title = meta.get("og:title") or meta.get("title") or parser.title
+    description = _json_field(page, "description") or meta.get("og:description") or meta.get("description") or ""
+    uploader = meta.get("uploader") or _json_field(page, "uploader") or meta.get("author") or ""
+    tags = parser.tags or _json_field(page, "keywords") or []
+    if not tags and meta.get("keywords"):
+        tags = meta["keywords"].split(",")
+    return {
+        "title": normalize(title),
+        "description": normalize(description),
+        "uploader": normalize(uploader),
+        "tags": [t for t in dict.fromkeys(normalize(t) for t in tags) if t],
+    }
+
+
+def compact(fields, token_budget=TOKEN_BUDGET):
+    """
+    Serializes fields to JSON no longer than token_budget tokens: tags are dropped from the end
+    first (down to 10), then the description is cut.
+    """
+    fields = dict(fields)
+    budget = token_budget * CHARS_PER_TOKEN
+    text = json.dumps(fields, ensure_ascii=False)
+    while len(text) > budget and len(fields["tags"]) > 10:
+        fields["tags"] = fields["tags"][:max(10, len(fields["tags"]) // 2)]
+        text = json.dumps(fields, ensure_ascii=False)
+    if len(text) > budget:
+        keep = max(0, len(fields["description"]) - (len(text) - budget) - 3)
+        fields["description"] = fields["description"][:keep] + "..."
+        text = json.dumps(fields, ensure_ascii=False)
+    return text
+
+
+def extract_page(path, token_budget=TOKEN_BUDGET):
+    """
+    Returns (compact JSON, tokens of the raw page, tokens of the JSON), or None if the page is missing.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        page = f.read()
+    text = compact(extract_fields(page), token_budget)
+    return text, estimate_tokens(page), estimate_tokens(text)
+
+
+def _extract_task(task):
+    return extract_page(*task)
+
+
+def extract_pages(urls, html_folder, token_budget=TOKEN_BUDGET, max_workers=None):
+    """
+    Extracts the saved pages of all urls in a process pool. Returns ({url: compact JSON}, stats).
+    """
+    urls = list(dict.fromkeys(url.strip() for url in urls))
+    tasks = [(page_path(url, html_folder), token_budget) for url in urls]
+    extracted = {}
+    raw_tokens, kept_tokens, missing = 0, 0, 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for url, result in zip(urls, executor.map(_extract_task, tasks, chunksize=16)):
+            if result is None:
+                missing += 1
+                continue
+            extracted[url], raw, kept = result
+            raw_tokens += raw
+            kept_tokens += kept
+    pages = len(extracted)
+    stats = {
+        "pages": pages,
+        "missing": missing,
+        "avg_raw_tokens": raw_tokens / max(pages, 1),
+        "avg_tokens": kept_tokens / max(pages, 1),
+        "reduction": 1.0 - kept_tokens / max(raw_tokens, 1),
+    }
+    return extracted, stats
+
+
+def format_stats(stats):
+    return ("Extracted %d pages (%d missing): %.0f -> %.0f tokens per page on average, %.1f%% fewer" % (
+        stats["pages"], stats["missing"], stats["avg_raw_tokens"], stats["avg_tokens"], 100.0 * stats["reduction"]))
+
+
+if __name__ == "__main__":
+    import sys
+    import pandas as pd
+    csv_file = pd.read_csv(sys.argv[1], dtype=str)
+    extracted, stats = extract_pages(csv_file['Url'].dropna(), sys.argv[2])
+    print(format_stats(stats))
@@ -0,0 +1,180 @@
+import os, re, json
+
+# A local pre-pass for clean_with_gpt.py. Rows whose title plainly says what they are (an "AI cover",
+# a so-vits/RVC conversion, an official MV, ...) and whose given singer appears in the title are
+# resolved here with the same fields the LLM returns; everything else is escalated to the LLM.
+# Matching is done on ASCII letter boundaries instead of \b, so "AI翻唱" or "【AI】" still match.
+
+def _word(pattern):
+    return r"(?<![a-z0-9])(?:" + pattern + r")(?![a-z0-9])"
+
+# canonical model name -> patterns found in titles; checked in order, the first match wins
+MODEL_ALIASES = [
+    ("so-vits-svc", [_word(r"so[\s\-_]*vits(?:[\s\-_]*svc)?(?:[\s\-_]*[0-9.]+)?"), _word(r"sovits")]),
+    ("rvc", [_word(r"rvc(?:[\s\-_]*v?[0-9])?"), r"retrieval[\s\-]*based[\s\-]*voice"]),
+    ("diff-svc", [_word(r"diff[\s\-_]*svc")]),
+    ("diffsinger", [_word(r"diff[\s\-_]*singer")]),
+    ("ddsp-svc", [_word(r"ddsp(?:[\s\-_]*svc)?")]),
+    ("svc", [_word(r"svc")]),
+]
+MODEL_PATTERNS = [(name, re.compile("|".join(patterns), re.IGNORECASE)) for name, patterns in MODEL_ALIASES]
+
+# "AI cover", "AI Taylor Swift", "【AI】"; upper case only, "ai"/"Ai" is also a common word in romanized titles
+AI_PATTERN = re.compile(r"(?<![A-Za-z0-9])(?:AI|A\.I\.)(?![A-Za-z0-9])")
+
+SPOOF_PATTERN = re.compile("|".join([
+    _word(r"ai[\s\-]*(?:cover|covers|song|singer|version|voice|vocals?)"),
+    r"ai\s*(?:翻唱|歌手|孫燕姿|孙燕姿)",
+    r"(?:翻唱|歌声|歌聲)\s*ai",
+    r"(?:人工智能|人工智慧|ai커버|ai 커버|ai歌ってみた|ai歌唱)",
+    _word(r"(?:voice|vocal)[\s\-]*(?:model|clone|cloning|conversion|changer)"),
+    _word(r"deep[\s\-]*fake"),
+]), re.IGNORECASE)
+
+BONAFIDE_PATTERN = re.compile("|".join([
+    _word(r"official\s+(?:music\s+)?(?:video|audio|mv|lyric\s+video|live\s+video)"),
+    _word(r"m/v"),
+    _word(r"vevo"),
+    r"\s-\s*topic$",
+    r"官方\s*(?:mv|music video|完整版)",
+    r"(?:公式|オフィシャル)",
+]), re.IGNORECASE)
+
+ALIAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "singer_aliases.json")
+
+
+def load_singer_aliases(path=ALIAS_FILE):
+    """
+    singer_aliases.json (optional) maps a canonical singer name to other spellings,
+    e.g. {"Stefanie Sun": ["孙燕姿", "孫燕姿", "Sun Yanzi"]}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        aliases = json.load(f)
+    return {name: [name] + list(others) for name, others in aliases.items()}
+
+
+SINGER_ALIASES = load_singer_aliases()
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+
+def singer_in_title(singer, title):
+    """
+    Returns the singer name (the canonical one if it has aliases) if `singer` or one of its aliases
+    is written in the title, otherwise None.
+    """
+    name = _normalize(singer)
+    if name in ("", "nan", "unknown"):
+        return None
+    title = _normalize(title)
+    for canonical, names in SINGER_ALIASES.items():
+        names = [_normalize(n) for n in names]
+        if name in names and any(n in title for n in names):
+            return canonical
+    return str(singer).strip() if name in title else None
+
+
+def singer_names(singer):
+    """
+    `singer` and its aliases, normalized.
+    """
+    name = _normalize(singer)
+    for names in SINGER_ALIASES.values():
+        names = [_normalize(n) for n in names]
+        if name in names:
+            return names
+    return [name]
+
+
+def strip_singer(title, singer):
+    """
+    The title without the singer's own name (and its aliases), so that a singer called e.g. "AI" is
+    not taken for a spoof cue.
+    """
+    for name in singer_names(singer):
+        if name in ("", "nan", "unknown"):
+            continue
+        pattern = r"\s+".join(re.escape(part) for part in name.split(" "))
+        title = re.sub(r"(?<![A-Za-z0-9])" + pattern + r"(?![A-Za-z0-9])", " ", title, flags=re.IGNORECASE)
+    return title
+
+
+def classify(title, singer):
+    """
+    Returns {"type", "singer", "model", "correct"} like the LLM does, or None if the row is ambiguous
+    and should be escalated.
+    """
+    title = str(title)
+    cues = strip_singer(title, singer)
+    spoof = AI_PATTERN.search(cues) is not None or SPOOF_PATTERN.search(cues) is not None
+    found_model = None
+    for name, pattern in MODEL_PATTERNS:
+        if pattern.search(cues):
+            found_model = name
+            break
+    spoof = spoof or found_model is not None
+    bonafide = BONAFIDE_PATTERN.search(cues) is not None
+    if spoof == bonafide:
+        # no cue, or contradicting cues (e.g. an "official" AI cover channel)
+        return None
+    singer_name = singer_in_title(singer, title)
+    if singer_name is None:
+        return None
+    if spoof:
+        return {"type": "spoof", "singer": singer_name, "model": found_model or "unknown", "correct": True}
+    return {"type": "bonafide", "singer": singer_name, "model": "unknown", "correct": True}
+
+
+def agrees(rule, llm):
+    """
+    Per-field agreement between a rule-based answer and the LLM answer for the same row.
+    """
+    return {
+        "type": _normalize(rule["type"]) == _normalize(llm["type"]),
+        "singer": _normalize(rule["singer"]) == _normalize(llm["singer"]),
+        # the LLM tends to spell models freely, so only compare them when both found one
+        "model": (_normalize(rule["model"]) == "unknown" or _normalize(llm["model"]) == "unknown"
+                  or _normalize(rule["model"]).replace("-", "") in _normalize(llm["model"]).replace("-", "")),
+        "correct": str(rule["correct"]).lower() == str(llm["correct"]).lower(),
+    }
+
+
+def report(resolved, total, agreements):
+    lines = ["Pre-filter resolved %d / %d rows, escalation rate %.1f%%" % (
+        resolved, total, 100.0 * (total - resolved) / max(total, 1))]
+    if len(agreements) > 0:
+        lines.append("Agreement with the LLM on %d resolved rows: " % len(agreements) + ", ".join(
+            "%s %.1f%%" % (field, 100.0 * sum(a[field] for a in agreements) / len(agreements))
+            for field in ["type", "singer", "model", "correct"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # dry run on a csv: escalation rate, and agreement with any LLM answers already in the cache
+    import sys
+    import pandas as pd
+    csv_file = pd.read_csv(sys.argv[1], dtype=str)
+    cache_path = sys.argv[2] if len(sys.argv) > 2 else "gpt_cache.jsonl"
+    cached = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                cached[entry["url"]] = entry["response"]
+    resolved, agreements = 0, []
+    for i in csv_file.index:
+        rule = classify(csv_file.at[i, 'Title'], csv_file.at[i, 'Singer'])
+        if rule is None:
+            continue
+        resolved += 1
+        url = str(csv_file.at[i, 'Url']).strip()
+        if url in cached:
+            agreements.append(agrees(rule, cached[url]))
+    print(report(resolved, len(csv_file), agreements))
@@ -0,0 +1,109 @@
+import os, argparse
+import numpy as np
+import soundfile as sf
+import librosa
+from concurrent.futures import ProcessPoolExecutor
+from audit import load_index, FOLDERS
+
+# Converts the clips of a split into one contiguous int16 file at 16 kHz, so training slices windows
+# out of a memmap instead of decoding and resampling a flac per __getitem__ (Dataset_SingFakeStore
+# in models/). Per split and folder (vocals or mixtures):
+#   <split>/<folder>.int16      all clips back to back, each stored channel by channel
+#                               (channel c of clip i is audio[offsets[i] + c * lengths[i]:][:lengths[i]])
+#   <split>/<folder>.store.npz  offsets int64, lengths int32 (frames), channels int16, labels int8,
+#                               peaks float32, and paths/path_offsets (utf-8 blob) of the source clips
+# Clips are peak-normalized before quantization (peaks keeps the original level); both training
+# pipelines normalize the level again anyway.
+
+STORE_SR = 16000
+AUDIO_SUFFIX = ".int16"
+INDEX_SUFFIX = ".store.npz"
+
+
+def store_paths(split_folder, folder):
+    return (os.path.join(split_folder, folder + AUDIO_SUFFIX), os.path.join(split_folder, folder + INDEX_SUFFIX))
+
+
+def list_clips(split_folder, folder):
+    """
+    Relative paths of the clips of one folder: the usable ones from the audit manifest (index.npz)
+    when there is one, otherwise every flac in the folder.
+    """
+    index = load_index(split_folder)
+    if index is not None:
+        paths, files, _, _ = index
+        folder_id = FOLDERS.index(folder)
+        return [path for path, row in zip(paths, files) if row["folder"] == folder_id and row["ok"]]
+    return [folder + "/" + name for name in sorted(os.listdir(os.path.join(split_folder, folder))) if name.endswith(".flac")]
+
+
+def convert_clip(path, sr=STORE_SR):
+    """
+    Returns (int16 samples, channel-major and flattened, frames, channels, peak), or None if the clip
+    cannot be decoded.
+    """
+    try:
+        X, file_sr = sf.read(path, dtype="float32", always_2d=True)
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return None
+    X = X.T
+    if file_sr != sr:
+        # the same resampler librosa.load(sr=...) uses
+        X = librosa.resample(X, orig_sr=file_sr, target_sr=sr)
+    peak = float(np.abs(X).max()) if X.size > 0 else 0.0
+    if peak > 0:
+        X = X / peak
+    samples = np.round(np.clip(X, -1.0, 1.0) * 32767).astype(np.int16)
+    return samples.reshape(-1), samples.shape[1], samples.shape[0], peak
+
+
+def _convert_task(task):
+    return convert_clip(*task)
+
+
+def build_store(split_folder, folder, sr=STORE_SR, max_workers=None):
+    clips = list_clips(split_folder, folder)
+    audio_path, index_path = store_paths(split_folder, folder)
+    offsets, lengths, channels, labels, peaks, kept = [], [], [], [], [], []
+    position = 0
+    tmp_path = audio_path + ".tmp"
+    with open(tmp_path, "wb") as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [(os.path.join(split_folder, clip), sr) for clip in clips]
+        for clip, result in zip(clips, executor.map(_convert_task, tasks, chunksize=16)):
+            if result is None or result[1] == 0:
+                continue
+            samples, frames, num_channels, peak = result
+            f.write(samples.tobytes())
+            offsets.append(position)
+            lengths.append(frames)
+            channels.append(num_channels)
+            # <label>_<song id>_<segment index>.flac, see split.py
+            labels.append(int(os.path.basename(clip).split("_")[0]))
+            peaks.append(peak)
+            kept.append(clip.encode("utf-8"))
+            position += len(samples)
+    os.replace(tmp_path, audio_path)
+
+    path_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in kept], out=path_offsets[1:])
+    np.savez(index_path, offsets=np.asarray(offsets, dtype=np.int64), lengths=np.asarray(lengths, dtype=np.int32),
+             channels=np.asarray(channels, dtype=np.int16), labels=np.asarray(labels, dtype=np.int8),
+             peaks=np.asarray(peaks, dtype=np.float32), sample_rate=np.int32(sr),
+             paths=np.frombuffer(b"".join(kept), dtype=np.uint8), path_offsets=path_offsets)
+    return len(kept), len(clips) - len(kept), position
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the clips of a split into one int16 memmap at 16 kHz.")
+    parser.add_argument("split_folder", type=str, help="e.g. split_dump/train, with vocals/ and mixtures/")
+    parser.add_argument("--folders", type=str, nargs="+", default=FOLDERS, choices=FOLDERS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for folder in args.folders:
+        if not os.path.isdir(os.path.join(args.split_folder, folder)):
+            continue
+        clips, skipped, samples = build_store(args.split_folder, folder, max_workers=args.workers)
+        print("%s: %d clips (%d skipped), %.2f hours of channel audio, %.2f GB" % (
+            folder, clips, skipped, samples / STORE_SR / 3600, samples * 2 / (1 << 30)))
@@ -0,0 +1,147 @@
+import os, argparse
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor
+
+# Audits the split folders written by split.py (train/, dev/, test/, ...; each with vocals/ and
+# mixtures/) and writes one columnar manifest per split, <split>/index.npz, which the Dataset_SingFake
+# classes in models/ load instead of listing the folder. Every file is fully decoded once here, so
+# corrupt or silent files are excluded up front instead of failing in __getitem__ every epoch.
+# Everything is kept in flat arrays (no arrays of Python strings), so loading is fast and forked
+# DataLoader workers share the pages instead of copying millions of refcounted objects.
+#   paths    utf-8 relative paths ("vocals/<name>.flac") concatenated into one uint8 blob
+#   offsets  int64, path i is paths[offsets[i]:offsets[i + 1]]
+#   files    AUDIT_DTYPE, one row per path; "song" indexes songs
+#   songs    song ids, as found in the file names
+#   errors   decode error per file, "" if none
+
+INDEX_NAME = "index.npz"
+FOLDERS = ["vocals", "mixtures"] # AUDIT_DTYPE "folder" indexes this list
+
+AUDIT_DTYPE = np.dtype([("folder", "i1"), ("label", "i1"), ("song", "<i4"), ("duration", "<f4"), ("sample_rate", "<i4"),
+                        ("channels", "<i2"), ("peak", "<f4"), ("ok", "?")])
+
+BLOCK_SIZE = 1 << 18 # frames decoded at a time
+
+
+def parse_name(name):
+    """
+    <label>_<song id>_<segment index>, see split.py. Returns (label, song id); label is -1 if the name
+    does not follow it.
+    """
+    parts = name.split("_")
+    try:
+        label = int(parts[0])
+    except ValueError:
+        label = -1
+    return label, "_".join(parts[1:-1]) if len(parts) > 2 else ""
+
+
+def audit_file(path):
+    """
+    Returns (duration, sample_rate, channels, peak, error) for one file. The whole file is decoded,
+    block by block, since truncated flac files often only fail near the end.
+    """
+    try:
+        with sf.SoundFile(path) as f:
+            sample_rate, channels, frames = f.samplerate, f.channels, f.frames
+            peak = 0.0
+            decoded = 0
+            for block in f.blocks(blocksize=BLOCK_SIZE, dtype="float32", always_2d=True):
+                decoded += len(block)
+                if len(block) > 0:
+                    peak = max(peak, float(np.abs(block).max()))
+        if decoded != frames:
+            return frames / sample_rate, sample_rate, channels, peak, "decoded %d of %d frames" % (decoded, frames)
+        return frames / sample_rate, sample_rate, channels, peak, ""
+    except Exception as e:
+        return 0.0, 0, 0, 0.0, str(e).replace("\n", " ") or type(e).__name__
+
+
+def _audit_task(task):
+    return audit_file(os.path.join(*task))
+
+
+def audit_split(split_folder, max_workers=None):
+    """
+    Audits vocals/ and mixtures/ of one split and returns (paths, files, songs, errors), with paths as
+    a list of relative paths.
+    """
+    tasks, folders = [], []
+    for folder_id, folder in enumerate(FOLDERS):
+        folder_path = os.path.join(split_folder, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            if name.endswith(".flac"):
+                tasks.append((folder_path, name))
+                folders.append(folder_id)
+
+    files = np.zeros(len(tasks), dtype=AUDIT_DTYPE)
+    errors, songs = [], {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_audit_task, tasks, chunksize=64)
+        for i, (result, (_, name)) in enumerate(zip(results, tasks)):
+            duration, sample_rate, channels, peak, error = result
+            label, song = parse_name(name[:-5])
+            if label < 0 and not error:
+                error = "no label in file name"
+            song = songs.setdefault(song, len(songs))
+            files[i] = (folders[i], label, song, duration, sample_rate, channels, peak,
+                        not error and duration > 0 and peak > 0)
+            errors.append(error if error or peak > 0 else "silent")
+    paths = [FOLDERS[folder_id] + "/" + name for folder_id, (_, name) in zip(folders, tasks)]
+    return paths, files, np.asarray(list(songs), dtype=np.str_), np.asarray(errors, dtype=np.str_)
+
+
+def save_index(split_folder, paths, files, songs, errors):
+    encoded = [path.encode("utf-8") for path in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    np.savez(os.path.join(split_folder, INDEX_NAME), paths=blob, offsets=offsets, files=files, songs=songs, errors=errors)
+
+
+def load_index(split_folder):
+    """
+    Returns (paths, files, songs, errors) with paths as a list of relative paths, or None if the split
+    has not been audited.
+    """
+    index_path = os.path.join(split_folder, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path, allow_pickle=False) as data:
+        blob, offsets = data["paths"].tobytes(), data["offsets"]
+        paths = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+        return paths, data["files"], data["songs"], data["errors"]
+
+
+def find_splits(root):
+    return sorted(name for name in os.listdir(root)
+                  if any(os.path.isdir(os.path.join(root, name, folder)) for folder in FOLDERS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode every file of the split folders and write a per-split index.")
+    parser.add_argument("root", type=str, help="folder holding the splits (train/, dev/, test/, ...), e.g. split.py's dump folder")
+    parser.add_argument("--splits", type=str, nargs="+", default=None, help="only audit these splits")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--verbose", action="store_true", help="print every excluded file")
+    args = parser.parse_args()
+
+    print("split\tfolder\tfiles\texcluded\thours\tspoof\tbonafide")
+    for split in args.splits or find_splits(args.root):
+        split_folder = os.path.join(args.root, split)
+        paths, files, songs, errors = audit_split(split_folder, args.workers)
+        save_index(split_folder, paths, files, songs, errors)
+        for folder_id, folder in enumerate(FOLDERS):
+            rows = files["folder"] == folder_id
+            if not rows.any():
+                continue
+            ok = rows & files["ok"]
+            print("%s\t%s\t%d\t%d\t%.2f\t%d\t%d" % (split, folder, rows.sum(), rows.sum() - ok.sum(),
+                                                    files["duration"][ok].sum() / 3600,
+                                                    (files["label"][ok] == 1).sum(), (files["label"][ok] == 0).sum()))
+            if args.verbose:
+                for i in np.flatnonzero(rows & ~files["ok"]):
+                    print("  excluded %s: %s" % (paths[i], errors[i]))
@@ -0,0 +1,94 @@
+import os, json, time, sqlite3, hashlib
+
+# A small sqlite job ledger shared by separate.py, split.py and simulate_codec.py.
+# Every source file is identified by the hash of its content, and every finished stage
+# (separate, vad, split:<segments hash>, codec:<format>_<bitrate>, ...) is recorded against that hash
+# together with its outputs and how long it took. Re-runs only process new or changed files.
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class JobLedger:
+    def __init__(self, path="./ledger.sqlite"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # files caches the content hash per path, so unchanged files are never read twice
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                mtime_ns INTEGER NOT NULL,
+                                hash TEXT NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS stages (
+                                hash TEXT NOT NULL,
+                                stage TEXT NOT NULL,
+                                source TEXT NOT NULL,
+                                outputs TEXT NOT NULL,
+                                duration REAL NOT NULL,
+                                finished_at REAL NOT NULL,
+                                PRIMARY KEY (hash, stage))""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def content_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = hash_file(path)
+        self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                          (path, stat.st_size, stat.st_mtime_ns, digest))
+        self.conn.commit()
+        return digest
+
+    def get(self, source, stage):
+        """
+        Returns the record of a finished stage as a dict, or None if the stage has not been run
+        for the current content of source.
+        """
+        row = self.conn.execute("SELECT outputs, duration, finished_at FROM stages WHERE hash = ? AND stage = ?",
+                                (self.content_hash(source), stage)).fetchone()
+        if row is None:
+            return None
+        return {"outputs": json.loads(row[0]), "duration": row[1], "finished_at": row[2]}
+
+    def is_done(self, source, stage, check_outputs=True):
+        record = self.get(source, stage)
+        if record is None:
+            return False
+        if check_outputs:
+            # outputs deleted by hand since the last run count as not done
+            return all(os.path.exists(output) for output in record["outputs"])
+        return True
+
+    def record(self, source, stage, outputs, duration):
+        self.conn.execute("INSERT OR REPLACE INTO stages (hash, stage, source, outputs, duration, finished_at) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (self.content_hash(source), stage, os.path.abspath(source),
+                           json.dumps(list(outputs)), float(duration), time.time()))
+        self.conn.commit()
+
+    def summary(self):
+        return dict(self.conn.execute("SELECT stage, COUNT(*) FROM stages GROUP BY stage").fetchall())
+
+
+if __name__ == "__main__":
+    import sys
+    ledger = JobLedger(sys.argv[1] if len(sys.argv) > 1 else "./ledger.sqlite")
+    for stage, count in sorted(ledger.summary().items()):
+        print(f"{stage}\t{count}")
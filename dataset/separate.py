@@ -1,15 +1,17 @@
-import os, sys
+import os, time, argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-import demucs.separate
-from pyannote.audio import Model, Inference
+import numpy as np
+import soundfile as sf
+import torch
+from demucs.pretrained import get_model
+from demucs.apply import apply_model
+from demucs.audio import AudioFile, save_audio
+from ledger import JobLedger
+import vad
 
-authtoken = None # Fill in your auth token
-assert authtoken is not None, "You must provide an auth token to use PyAnnote VAD pipeline."
-
-model = Model.from_pretrained("pyannote/segmentation", use_auth_token=authtoken)
-
-from pyannote.audio.pipelines import VoiceActivityDetection
-pipeline = VoiceActivityDetection(segmentation=model)
+authtoken = None # Fill in your auth token (only needed for the pyannote VAD backend)
 
 HYPER_PARAMETERS = {
   # onset/offset activation thresholds
@@ -19,53 +21,206 @@ HYPER_PARAMETERS = {
   # fill non-speech regions shorter than that many seconds.
   "min_duration_off": 0.0,
 }
-pipeline.instantiate(HYPER_PARAMETERS)
-
-def run_vad(file_path):
-    vad = pipeline(file_path)
-    vad = str(vad)
-    # note that this step only generates a "*.vad" file
-    # this file will be of the same name but different extension (.vad)
-    with open(file_path.replace(".wav", ".vad"), "w") as f:
-        f.write(vad)
-
-if len(sys.argv)!= 2:
-    print("Usage: python dataset-separate.py <download_dump_dir>")
-    print("The 'download_dump_dir' is the directory where the download dump files are stored.")
-    print("Expecting results in the format produced by dataset-download.py")
-    exit(1)
-
-download_dump_dir = sys.argv[1]
-
-default_output_dir = "./mdx_extra"
-
-# note that the following are just one of many implementation possibilities
-
-# this part assumes you keep some sort of log during download.
-logs = []
-for filename in os.listdir(download_dump_dir):
-    if filename.endswith(".log"):
-        logs.append(os.path.join(download_dump_dir, filename))
-        
-target_file_names = []
-for log in logs:
-    # here we parse the logs you kept during download.
-    with open(log, "r") as f:
-        lines = f.readlines()
-        # we assume the first line of your download function is a target file name.
-        target_file_names.append(lines[0].strip() + ".flac")
-
-folder_names = os.listdir(default_output_dir)
-for name in target_file_names:
-    # if appears already in the output folder, skip
-    for folder_name in folder_names:
-        if folder_name == name.replace(".flac", ""):
-            print(name + " appears already in the output folder, skipping...")
-            target_file_names.remove(name)
-
-for target_file_name in tqdm(target_file_names, desc="Separate Vocals"):
-    # we call demucs to separate the vocals.
-    os.system("demucs --two-stems=vocals -n mdx_extra \"" + os.path.join(download_dump_dir, target_file_name) + "\"" )
-
-    # after then, we run vocals.wav through the vad defined as above.
-    run_vad(os.path.join(default_output_dir, target_file_name.replace(".flac", "/vocals.wav")))
\ No newline at end of file
+
+def load_vad_pipeline(backend="pyannote"):
+    if backend == "energy":
+        # energy + spectral flux, see vad.energy_scores; no model and no download needed
+        return None
+    assert authtoken is not None, "You must provide an auth token to use PyAnnote VAD pipeline."
+    from pyannote.audio import Model, Inference
+
+    model = Model.from_pretrained("pyannote/segmentation", use_auth_token=authtoken)
+    # this is the inference step of pyannote's VoiceActivityDetection pipeline; the binarization
+    # happens in vad.binarize, so the raw scores can be cached and re-thresholded later.
+    return Inference(model, pre_aggregation_hook=lambda scores: np.max(scores, axis=-1, keepdims=True))
+
+def run_vad(pipeline, file_path, legacy_vad=False, backend="pyannote"):
+    song_dir = os.path.dirname(file_path)
+    if backend == "energy":
+        wave, sr = sf.read(file_path, dtype="float32", always_2d=True)
+        scores, timing = vad.energy_scores(wave.T, sr)
+        vad.save_scores(song_dir, scores, timing["start"], timing["step"], timing["duration"], backend)
+    else:
+        scores = pipeline(file_path)
+        window = scores.sliding_window
+        vad.save_scores(song_dir, scores.data, window.start, window.step, window.duration)
+    scores, timing = vad.load_scores(song_dir, backend)
+    segments = vad.binarize(scores, timing, **HYPER_PARAMETERS)
+    # this step generates a "vocals.segments.npy" table next to the vocal stem,
+    # vad.py gathers them into one table per corpus.
+    segments_path = os.path.join(song_dir, vad.song_file(vad.SONG_SEGMENTS_NAME, backend))
+    vad.save_song_segments(segments_path, segments)
+    outputs = [segments_path, os.path.join(song_dir, vad.song_file(vad.SCORES_NAME, backend))]
+    if legacy_vad:
+        # the old "*.vad" text file, same name but different extension (.vad)
+        vad_path = file_path.replace(".wav", ".vad")
+        with open(vad_path, "w") as f:
+            f.write(vad.to_legacy(segments))
+        outputs.append(vad_path)
+    return outputs
+
+
+# the separator lives in each worker process, so the demucs weights are loaded once per worker
+# instead of once per song (which is what calling the demucs CLI for every file did).
+_separator = {}
+
+def init_separator(model_name, segment, device, num_threads):
+    torch.set_num_threads(num_threads)
+    model = get_model(model_name)
+    model.to(device)
+    model.eval()
+    _separator["model"] = model
+    _separator["segment"] = segment
+    _separator["device"] = device
+
+def separate_song(src_path, out_dir):
+    model = _separator["model"]
+    timings = {"song": os.path.basename(out_dir)}
+
+    start = time.perf_counter()
+    wav = AudioFile(src_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+    timings["load"] = time.perf_counter() - start
+    timings["duration"] = wav.shape[-1] / model.samplerate
+
+    # same normalization as demucs.separate
+    start = time.perf_counter()
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / ref.std()
+    with torch.no_grad():
+        sources = apply_model(model, wav[None], device=_separator["device"], split=True, overlap=0.25,
+                              segment=_separator["segment"], progress=False)[0]
+    sources = sources * ref.std() + ref.mean()
+    timings["separate"] = time.perf_counter() - start
+
+    # equivalent of --two-stems=vocals: vocals and the sum of everything else
+    start = time.perf_counter()
+    vocals = sources[model.sources.index("vocals")]
+    no_vocals = sources.sum(0) - vocals
+    os.makedirs(out_dir, exist_ok=True)
+    save_audio(vocals.cpu(), os.path.join(out_dir, "vocals.wav"), samplerate=model.samplerate)
+    save_audio(no_vocals.cpu(), os.path.join(out_dir, "no_vocals.wav"), samplerate=model.samplerate)
+    timings["write"] = time.perf_counter() - start
+    timings["total"] = timings["load"] + timings["separate"] + timings["write"]
+    return timings
+
+def write_report(report_path, timings):
+    columns = ["song", "duration", "load", "separate", "write", "total", "vad"]
+    with open(report_path, "w") as f:
+        # realtime_factor covers separation only (load + separate + write), vad runs in this process
+        f.write("\t".join(columns + ["realtime_factor"]) + "\n")
+        for t in timings:
+            values = [t["song"]] + ["%.3f" % t[c] for c in columns[1:]]
+            values.append("%.3f" % (t["duration"] / max(t["total"], 1e-6)))
+            f.write("\t".join(values) + "\n")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Separate vocals with Demucs and run VAD on the vocal stems.")
+    parser.add_argument("download_dump_dir", type=str,
+                        help="directory where the download dump files (*.flac and *.log) are stored")
+    parser.add_argument("-o", "--output_dir", type=str, default="./mdx_extra", help="where the separated stems go")
+    parser.add_argument("-n", "--model", type=str, default="mdx_extra", help="demucs pretrained model name")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of separation worker processes (default: number of CPUs)")
+    parser.add_argument("--segment", type=float, default=None,
+                        help="demucs segment length in seconds; smaller values use less memory")
+    parser.add_argument("--device", type=str, default="cpu", help="device used by every separation worker")
+    parser.add_argument("--report", type=str, default="separation_report.tsv", help="per-song timing report")
+    parser.add_argument("--vad_backend", type=str, default="pyannote", choices=vad.BACKENDS,
+                        help="pyannote segmentation model, or the offline energy/spectral flux detector")
+    parser.add_argument("--legacy_vad", action="store_true", help="also write the old *.vad text files")
+    parser.add_argument("--ledger", type=str, default="./ledger.sqlite", help="job ledger shared by the dataset scripts")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    download_dump_dir = args.download_dump_dir
+
+    # note that the following are just one of many implementation possibilities
+
+    # this part assumes you keep some sort of log during download.
+    logs = []
+    for filename in os.listdir(download_dump_dir):
+        if filename.endswith(".log"):
+            logs.append(os.path.join(download_dump_dir, filename))
+
+    target_file_names = []
+    for log in logs:
+        # here we parse the logs you kept during download.
+        with open(log, "r") as f:
+            lines = f.readlines()
+            # we assume the first line of your download function is a target file name.
+            target_file_names.append(lines[0].strip() + ".flac")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    ledger = JobLedger(args.ledger)
+    # the pyannote stage keeps its original name, other backends are tracked separately
+    vad_stage_name = "vad" if args.vad_backend == "pyannote" else "vad:" + args.vad_backend
+    pending, vad_only = [], []
+    for name in target_file_names:
+        src_path = os.path.join(download_dump_dir, name)
+        out_dir = os.path.join(args.output_dir, name.replace(".flac", ""))
+        stems = [os.path.join(out_dir, "vocals.wav"), os.path.join(out_dir, "no_vocals.wav")]
+        if not ledger.is_done(src_path, "separate") and all(os.path.exists(stem) for stem in stems):
+            # separated before the ledger existed: adopt the stems instead of running demucs again
+            ledger.record(src_path, "separate", stems, 0.0)
+        # skip songs whose current content has already been through a stage
+        if not ledger.is_done(src_path, "separate"):
+            pending.append(name)
+        elif not ledger.is_done(src_path, vad_stage_name):
+            vad_only.append(name)
+        else:
+            print(name + " is already separated, skipping...")
+
+    pipeline = load_vad_pipeline(args.vad_backend)
+
+    def vad_stage(src_path, out_dir):
+        start = time.perf_counter()
+        outputs = run_vad(pipeline, os.path.join(out_dir, "vocals.wav"), args.legacy_vad, args.vad_backend)
+        duration = time.perf_counter() - start
+        ledger.record(src_path, vad_stage_name, outputs, duration)
+        return duration
+
+    for name in tqdm(vad_only, desc="VAD"):
+        vad_stage(os.path.join(download_dump_dir, name), os.path.join(args.output_dir, name.replace(".flac", "")))
+
+    workers = max(1, args.workers)
+    num_threads = max(1, os.cpu_count() // workers)
+    timings = []
+    # spawn, so CUDA and the pyannote pipeline in this process are never forked into the workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_separator,
+                             initargs=(args.model, args.segment, args.device, num_threads)) as executor:
+        futures = {}
+        for target_file_name in pending:
+            src_path = os.path.join(download_dump_dir, target_file_name)
+            out_dir = os.path.join(args.output_dir, target_file_name.replace(".flac", ""))
+            future = executor.submit(separate_song, src_path, out_dir)
+            futures[future] = (src_path, out_dir)
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Separate Vocals"):
+            src_path, out_dir = futures[future]
+            try:
+                song_timings = future.result()
+            except Exception as e:
+                print(f"Failed to separate {out_dir}: {e}")
+                continue
+            ledger.record(src_path, "separate",
+                          [os.path.join(out_dir, "vocals.wav"), os.path.join(out_dir, "no_vocals.wav")],
+                          song_timings["total"])
+            # after then, we run vocals.wav through the vad defined as above.
+            song_timings["vad"] = vad_stage(src_path, out_dir)
+            timings.append(song_timings)
+
+    songs, segments = vad.build_table(args.output_dir, backend=args.vad_backend)
+    print("VAD table: %d songs, %d segments" % (len(songs), len(segments)))
+
+    write_report(args.report, timings)
+    if len(timings) > 0:
+        total_audio = sum(t["duration"] for t in timings)
+        total_sep = sum(t["total"] for t in timings)
+        print("Separated %d songs (%.1f min of audio) in %.1f worker-min, %.1fx realtime per worker." % (
+            len(timings), total_audio / 60, total_sep / 60, total_audio / max(total_sep, 1e-6)))
+    print("Timing report written to " + args.report)
+
+if __name__ == "__main__":
+    main()
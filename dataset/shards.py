@@ -0,0 +1,113 @@
+import os, io, json, tarfile
+import soundfile as sf
+
+# Tar shards for split segments, in the WebDataset layout: the members of one sample share a key
+# and sit next to each other in the archive.
+#   {key}.vocals.flac    vocal stem segment
+#   {key}.mixture.flac   mixture segment
+#   {key}.json           metadata (label, song, index, start, end, seconds, sample_rate)
+# shards.json next to the shards records how many samples each shard holds.
+
+SHARD_INDEX_NAME = "shards.json"
+SHARD_SIZE = 1 << 30 # ~1 GB per shard
+
+
+def encode_flac(data, sr):
+    buffer = io.BytesIO()
+    sf.write(buffer, data, sr, format="FLAC", subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def load_index(folder):
+    index_path = os.path.join(folder, SHARD_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+class ShardWriter:
+    """
+    Appends samples to numbered tar shards under folder, starting a new shard once the current one
+    would grow past max_bytes. Existing shards are never reopened; a new run continues numbering.
+    """
+    def __init__(self, folder, max_bytes=SHARD_SIZE, prefix="shard"):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        os.makedirs(folder, exist_ok=True)
+        self.index = load_index(folder)
+        self.shard_id = len(self.index)
+        self.tar = None
+        self.path = None
+        self.size = 0
+
+    def _next_shard(self):
+        self.close_shard()
+        self.path = os.path.join(self.folder, "%s-%06d.tar" % (self.prefix, self.shard_id))
+        self.shard_id += 1
+        self.tar = tarfile.open(self.path, "w")
+        self.size = 0
+        self.index[os.path.basename(self.path)] = 0
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        # 512 byte header plus data padded to 512 bytes
+        self.size += 512 + (len(data) + 511) // 512 * 512
+
+    def write(self, key, vocals, mixture, metadata):
+        """
+        vocals and mixture are encoded audio bytes (see encode_flac). Returns the shard path.
+        """
+        metadata = json.dumps(metadata).encode("utf-8")
+        sample_size = len(vocals) + len(mixture) + len(metadata) + 3 * 1024
+        if self.tar is None or (self.size > 0 and self.size + sample_size > self.max_bytes):
+            self._next_shard()
+        self._add(key + ".vocals.flac", vocals)
+        self._add(key + ".mixture.flac", mixture)
+        self._add(key + ".json", metadata)
+        self.index[os.path.basename(self.path)] += 1
+        return self.path
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+            # the index is only updated for finished shards
+            with open(os.path.join(self.folder, SHARD_INDEX_NAME), "w") as f:
+                json.dump(self.index, f, indent=1)
+
+    def close(self):
+        self.close_shard()
+
+
+def iterate_shard(path):
+    """
+    Reads a shard sequentially and yields one dict per sample: {"__key__": key, "vocals.flac": bytes, ...}.
+    The model stacks (models/*/dataset.py, models/*/data_utils.py) carry copies of this function;
+    change them together with the shard layout.
+    """
+    sample = None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, field = member.name.split(".", 1)
+            if sample is not None and sample["__key__"] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {"__key__": key}
+            sample[field] = tar.extractfile(member).read()
+    if sample is not None:
+        yield sample
+
+
+if __name__ == "__main__":
+    import sys
+    folder = sys.argv[1]
+    index = load_index(folder)
+    total_bytes = sum(os.path.getsize(os.path.join(folder, name)) for name in index)
+    print("%d shards, %d samples, %.1f GB" % (len(index), sum(index.values()), total_bytes / (1 << 30)))
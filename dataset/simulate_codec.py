@@ -1,36 +1,21 @@
-from pydub import AudioSegment
-import os, shutil
+import os, io, time
+import numpy as np
+import soundfile as sf
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 import subprocess
+from ledger import JobLedger
 
 # This is the script used for simulating T03 (codec set) from T02.
+# Every source flac is decoded once and round-tripped through all requested (format, bitrate)
+# configurations in memory, with PyAV when it can encode the codec and ffmpeg pipes otherwise.
+# No temp files are written and ffmpeg's console output is captured.
 
-def simulate_codec(input_path, temp_path, output_path, format, bitrate="128k", codec=None):
-    # Convert the input file to the temporary path using ffmpeg
-    if codec:
-        subprocess.run(['ffmpeg', '-i', input_path, '-acodec', codec, '-b:a', bitrate, '-y', temp_path])
-    else:
-        subprocess.run(['ffmpeg', '-i', input_path, '-b:a', bitrate, '-y', temp_path])
-    # Read the temporary file and convert it back to flac
-    subprocess.run(['ffmpeg', '-i', temp_path, '-acodec', 'flac', '-y', output_path])
-
-    # Remove the temporary file
-    os.remove(temp_path)
+try:
+    import av
+except ImportError:
+    av = None
 
-    
-def format_suffix(format):
-    if format == "mp3":
-        return "mp3"
-    elif format == "adts":
-        return "aac"
-    elif format == "ogg":
-        return "ogg"
-    elif format == "opus":
-        return "opus"
-    else:
-        raise ValueError(f"Invalid format {format}")
-    
 def format_codec(format):
     if format == "mp3":
         return "libmp3lame"
@@ -42,43 +27,139 @@ def format_codec(format):
         # raise ValueError(f"Invalid format {format}")
         return None
 
-def worker(file_tuple):
-    src_file_path, dest_file_path, format, bitrate, src_file_name = file_tuple
-    temp_path = os.path.join(dest_file_path.split(".flac")[0] + f".{format_suffix(format)}")
+def encoder_name(format):
+    # format_codec leaves the choice to ffmpeg for adts and opus, the in-memory encoder needs a name
+    return format_codec(format) or {"adts": "aac", "opus": "libopus"}[format]
+
+def encoder_rate(format, sr):
+    # opus only encodes at 48 kHz, the others keep the source rate
+    return 48000 if format == "opus" else sr
+
+def parse_bitrate(bitrate):
+    bitrate = str(bitrate).lower()
+    if bitrate.endswith("k"):
+        return int(float(bitrate[:-1]) * 1000)
+    return int(bitrate)
+
+def can_encode(format):
+    if av is None:
+        return False
     try:
-        simulate_codec(src_file_path, temp_path, dest_file_path, format=format, bitrate=bitrate, codec=format_codec(format))
+        av.codec.Codec(encoder_name(format), "w")
+    except Exception:
+        return False
+    return True
+
+def roundtrip_av(wave, sr, format, bitrate):
+    """
+    Encodes wave (samples, channels) float32 into `format` in memory with PyAV and decodes it back
+    to float32 at sr. The encoder resamples to its own sample format and frame size by itself.
+    """
+    layout = "mono" if wave.shape[1] == 1 else "stereo"
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format=format) as container:
+        stream = container.add_stream(encoder_name(format), rate=encoder_rate(format, sr))
+        stream.bit_rate = parse_bitrate(bitrate)
+        stream.layout = layout
+        frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(wave.T), format="fltp", layout=layout)
+        frame.sample_rate = sr
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+    buffer.seek(0)
+    resampler = av.AudioResampler(format="fltp", layout=layout, rate=sr)
+    chunks = []
+    with av.open(buffer, "r") as container:
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray())
+    for out in resampler.resample(None):
+        chunks.append(out.to_ndarray())
+    return np.concatenate(chunks, axis=1).T
+
+def roundtrip_ffmpeg(wave, sr, format, bitrate):
+    """
+    Same as roundtrip_av with two ffmpeg processes: raw float32 in through stdin, encoded stream
+    out through stdout, and back again. Used for codecs the installed PyAV cannot encode.
+    """
+    channels = str(wave.shape[1])
+    raw = ["-f", "f32le", "-ar", str(sr), "-ac", channels]
+    codec = ["-acodec", format_codec(format)] if format_codec(format) else []
+    encoded = subprocess.run(["ffmpeg", "-v", "error"] + raw + ["-i", "pipe:0"] + codec +
+                             ["-b:a", bitrate, "-f", format, "pipe:1"],
+                             input=wave.astype(np.float32).tobytes(), capture_output=True, check=True).stdout
+    decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", "pipe:0"] + raw + ["pipe:1"],
+                             input=encoded, capture_output=True, check=True).stdout
+    return np.frombuffer(decoded, dtype=np.float32).reshape(-1, wave.shape[1])
+
+def worker(task):
+    """
+    task is (src_file_path, [(format, bitrate, dest_file_path), ...]). The source is decoded once for
+    all configurations. Returns (src_file_path, [(format, bitrate, dest_file_path, duration), ...])
+    for the configurations that succeeded.
+    """
+    src_file_path, configs = task
+    finished = []
+    try:
+        wave, sr = sf.read(src_file_path, dtype="float32", always_2d=True)
     except Exception as e:
-        print(f"Failed to simulate {src_file_path}")
-        print(e)
+        print(f"Failed to read {src_file_path}: {e}")
+        return src_file_path, finished
+    for format, bitrate, dest_file_path in configs:
+        start = time.perf_counter()
+        try:
+            if can_encode(format):
+                coded = roundtrip_av(wave, sr, format, bitrate)
+            else:
+                coded = roundtrip_ffmpeg(wave, sr, format, bitrate)
+            os.makedirs(os.path.dirname(dest_file_path), exist_ok=True)
+            sf.write(dest_file_path, coded, sr, format="FLAC")
+        except Exception as e:
+            stderr = getattr(e, "stderr", None)
+            print(f"Failed to simulate {format}_{bitrate} for {src_file_path}: {e}" +
+                  (f"\n{stderr.decode(errors='replace')}" if stderr else ""))
+            continue
+        finished.append((format, bitrate, dest_file_path, time.perf_counter() - start))
+    return src_file_path, finished
 
-def process_audio_files(src_folder, dest_folder, format="mp3", bitrate="128k", max_workers=None):
-    file_list = []
+def process_audio_files(src_folder, dest_folder, audio_formats, max_workers=None, ledger=None):
+    """
+    Walks src_folder once. Each flac gets one task covering every (format, bitrate) whose output,
+    dest_folder/<format>_<bitrate>/<relative path>, does not exist yet.
+    """
+    tasks = []
     for subdir, _, files in os.walk(src_folder):
         for file in files:
             if file.endswith('.flac'):
                 src_file_path = os.path.join(subdir, file)
-                
-                # Create the corresponding output directory
                 rel_path = os.path.relpath(subdir, src_folder)
-                dest_subdir = os.path.join(dest_folder, rel_path)
-                os.makedirs(dest_subdir, exist_ok=True)
-                
-                dest_file_path = os.path.join(dest_subdir, file)
-                
-                file_list.append((src_file_path, dest_file_path, format, bitrate, file))
+                configs = []
+                for format, bitrate in audio_formats:
+                    dest_file_path = os.path.join(dest_folder, f"{format}_{bitrate}", rel_path, file)
+                    if os.path.exists(dest_file_path):
+                        continue
+                    if ledger is not None and ledger.is_done(src_file_path, f"codec:{format}_{bitrate}"):
+                        continue
+                    configs.append((format, bitrate, dest_file_path))
+                if len(configs) > 0:
+                    tasks.append((src_file_path, configs))
 
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        list(tqdm(executor.map(worker, file_list), total=len(file_list), desc=f"Processing {src_folder}"))
+        for src_file_path, finished in tqdm(executor.map(worker, tasks), total=len(tasks), desc=f"Processing {src_folder}"):
+            if ledger is None:
+                continue
+            for format, bitrate, dest_file_path, duration in finished:
+                ledger.record(src_file_path, f"codec:{format}_{bitrate}", [dest_file_path], duration)
 
 audio_formats = None # write audio formats you want
 assert audio_formats is not None, "You must specify audio codec formats!"
 # example: [["ogg", "64k"], ["opus", "64k"]]
 
-for audio_format_tuple in audio_formats:
-    audio_format = audio_format_tuple[0]
-    bitrate = audio_format_tuple[1]
-    print("Processing " + audio_format + "...")
-    src_folder = "/home/yongyi/split_0831/test"
-    dest_folder = "/home/yongyi/split_0831/codec_test/"
-    dest_folder = dest_folder + audio_format + "_" + bitrate + "/"
-    process_audio_files(src_folder, dest_folder, format=audio_format, bitrate=bitrate, max_workers=8)
+ledger = JobLedger("./ledger.sqlite") # shared with separate.py and split.py
+
+src_folder = "/home/yongyi/split_0831/test"
+dest_folder = "/home/yongyi/split_0831/codec_test/" # one <format>_<bitrate>/ folder per configuration
+print("Processing " + ", ".join(f"{f}_{b}" for f, b in audio_formats) + "...")
+process_audio_files(src_folder, dest_folder, audio_formats, max_workers=8, ledger=ledger)
@@ -1,12 +1,15 @@
-import os, sys, librosa
-import numpy as np
+import os, sys, time, math, hashlib, librosa
 import soundfile as sf
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ledger import JobLedger
+from vad import VAD_SR, CORPUS_TABLE_NAME, load_table, song_slices
+from shards import ShardWriter, SHARD_SIZE, encode_flac
 
 
 # customize these three paths
 
-source_folder = "./mdx_extra" # where the separated files are. This script assumes you have ran separate.py before, and *.vad are under the same folder with file name adhereing to the same logic as written in separate.py.
+source_folder = "./mdx_extra" # where the separated files are. This script assumes you have ran separate.py before, which leaves the VAD segment table (vad_segments.npz) in this folder.
 
 logs_folder = "./logs" # It needs the *.log files (similar to separate.py)
 
@@ -14,81 +17,177 @@ dump_folder = "./split_dump" # output
 
 output_sr = 16000 # sample rate for output of all files.
 
-vad_files = []
-
-for root, dirs, files in os.walk(source_folder):
-    for file in files:
-        if file.endswith(".vad"):
-            vad_files.append(os.path.join(root, file))
-
-for vad_file in tqdm(vad_files, desc="Rendering Splits"):
-    vocal_only = vad_file.replace('.vad', '.wav')
-    corresponding_log = os.path.join(logs_folder, vad_file.split("/")[-2].split("_")[0] + ".log")
-    # here, it uses the logs file during download to determine if the file is spoof or bonafide.
-    spoof = 0
-    with open(corresponding_log, "r") as f:
-        curr_lines = f.readlines()
-        if curr_lines[4].strip() == "spoof":
-            spoof = 1
-        # this tag is directly written in file name!
-        # dataloaders in models/(model) also adhere to this logic.
-        mixture_file_name = curr_lines[0].strip() + ".flac"
-    mixture_file = os.path.join(logs_folder, mixture_file_name)
-    
-    # open both
-    vocal, vocal_sr = librosa.load(vocal_only, sr=output_sr, mono=False)
-    mixture, mixture_sr = librosa.load(mixture_file, sr=output_sr, mono=False)
-    
-    isMono = False
-    
-    if len(vocal.shape) == 1:
-        isMono = True
-    
-    if len(mixture.shape) == 1:
-        isMono = True
-    
-    index = 0
-    
-    with open(vad_file, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.strip()
-            if line == "":
-                continue
-            else:
-                try:
-                    items = line.split("]")[0].split("[")[1].split("-->")
-                    start_times = items[0].split(":")
-                    end_times = items[1].split(":")
-                    
-                    start_time = float(start_times[2]) + float(start_times[1]) * 60.0 + float(start_times[0]) * 3600.0
-                    end_time = float(end_times[2]) + float(end_times[1]) * 60.0 + float(end_times[0]) * 3600.0
-                    if isMono:
-                        vocal_curr_seg = vocal[int(start_time * output_sr):int(end_time * output_sr)]
-                        mixture_curr_seg = mixture[int(start_time * output_sr):int(end_time * output_sr)]
-                        vocal_curr_seg = np.expand_dims(vocal_curr_seg, axis=0)
-                        mixture_curr_seg = np.expand_dims(mixture_curr_seg, axis=0)
-                        
-                        # transpose
-                        vocal_curr_seg = np.transpose(vocal_curr_seg)
-                        mixture_curr_seg = np.transpose(mixture_curr_seg)
-                    else:
-                        vocal_curr_seg = vocal[:, int(start_time * output_sr):int(end_time * output_sr)]
-                        mixture_curr_seg = mixture[:, int(start_time * output_sr):int(end_time * output_sr)]
-                        
-                        # transpose
-                        vocal_curr_seg = np.transpose(vocal_curr_seg)
-                        mixture_curr_seg = np.transpose(mixture_curr_seg)
-                    
-                    file_name = str(spoof) + "_" + vad_file.split("/")[-2].split("_")[0] + "_" + str(index) + ".flac"
-                    
+filter_padding = 0.1 # seconds decoded on each side of a segment, so the resampling filter has context at the edges.
+
+num_workers = os.cpu_count() # songs are rendered in parallel, one song per task.
+
+output_mode = "files" # "files": one flac per segment under vocals/ and mixtures/, "shards": ~1 GB tar shards under shards/ (see shards.py).
+
+summary_file = os.path.join(dump_folder, "split_summary.tsv") # per-song segments, seconds and errors.
+
+ledger_file = "./ledger.sqlite" # shared with separate.py and simulate_codec.py
+
+def read_window(audio_file, start, end, target_sr, padding):
+    """
+    Reads samples [start, end) (counted at target_sr) from an open SoundFile and returns them
+    resampled to target_sr with shape (samples, channels). Only the window plus `padding` seconds
+    on each side is decoded, so memory is bounded by the segment, not by the song.
+    """
+    sr = audio_file.samplerate
+    if sr == target_sr:
+        audio_file.seek(start)
+        return audio_file.read(end - start, dtype="float32", always_2d=True)
+    # align the read start to a multiple of sr / gcd(sr, target_sr) samples, which falls
+    # exactly on a sample of the resampled signal
+    step = sr // math.gcd(sr, target_sr)
+    pad = int(round(padding * sr))
+    read_start = max(0, start * sr // target_sr - pad) // step * step
+    read_end = min(audio_file.frames, -(-end * sr // target_sr) + pad)
+    audio_file.seek(read_start)
+    window = audio_file.read(read_end - read_start, dtype="float32", always_2d=True)
+    window = librosa.resample(window.T, orig_sr=sr, target_sr=target_sr).T
+    offset = read_start * target_sr // sr
+    return window[start - offset:end - offset]
+
+def split_stage(starts, ends):
+    """
+    Ledger stage of a song split at these segment boundaries. The boundaries are part of the name, so a
+    song is split again once vad.py has re-binarized (or another backend has rewritten) its segments.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(starts.tobytes())
+    h.update(ends.tobytes())
+    return "split:" + h.hexdigest()
+
+def render_song(task):
+    """
+    Renders all segments of one song. Segment indices count the song's own segments in table order,
+    so file names do not depend on which worker renders the song or in which order songs finish.
+    """
+    song_dir, song_id, spoof, mixture_file, starts, ends, stage = task
+    start = time.perf_counter()
+    summary = {"song": song_dir, "mixture": mixture_file, "stage": stage, "segments": 0, "seconds": 0.0, "errors": [], "outputs": [], "samples": []}
+    vocal_only = os.path.join(source_folder, song_dir, "vocals.wav")
+    try:
+        # open both, only the segments are decoded
+        vocal = sf.SoundFile(vocal_only)
+    except Exception as e:
+        summary["errors"].append("open: " + str(e))
+        return summary
+    try:
+        mixture = sf.SoundFile(mixture_file)
+    except Exception as e:
+        vocal.close()
+        summary["errors"].append("open: " + str(e))
+        return summary
+
+    with vocal, mixture:
+        for index, (seg_start, seg_end) in enumerate(zip(starts, ends)):
+            try:
+                # (samples, channels)
+                vocal_curr_seg = read_window(vocal, int(seg_start), int(seg_end), output_sr, filter_padding)
+                mixture_curr_seg = read_window(mixture, int(seg_start), int(seg_end), output_sr, filter_padding)
+
+                key = str(spoof) + "_" + song_id + "_" + str(index)
+                file_name = key + ".flac"
+
+                if output_mode == "shards":
+                    # encoded here, the main process appends them to the shards in song order
+                    metadata = {"label": spoof, "song": song_id, "index": index, "start": int(seg_start), "end": int(seg_end),
+                                "seconds": len(vocal_curr_seg) / output_sr, "sample_rate": output_sr}
+                    summary["samples"].append((key, encode_flac(vocal_curr_seg, output_sr),
+                                               encode_flac(mixture_curr_seg, output_sr), metadata))
+                else:
                     # save vocal
-                    sf.write(os.path.join(dump_folder, "vocals", file_name), vocal_curr_seg, vocal_sr, subtype="PCM_16")
-                    
+                    sf.write(os.path.join(dump_folder, "vocals", file_name), vocal_curr_seg, output_sr, subtype="PCM_16")
+
                     # save mixture
-                    sf.write(os.path.join(dump_folder, "mixtures", file_name), mixture_curr_seg, mixture_sr, subtype="PCM_16")
-                    
-                    index += 1
-                except Exception as e:
-                    print(e)
-                    continue
\ No newline at end of file
+                    sf.write(os.path.join(dump_folder, "mixtures", file_name), mixture_curr_seg, output_sr, subtype="PCM_16")
+                    summary["outputs"].append(os.path.join(dump_folder, "vocals", file_name))
+                    summary["outputs"].append(os.path.join(dump_folder, "mixtures", file_name))
+                summary["segments"] += 1
+                summary["seconds"] += len(vocal_curr_seg) / output_sr
+            except Exception as e:
+                summary["errors"].append("segment %d: %s" % (index, e))
+    summary["duration"] = time.perf_counter() - start
+    return summary
+
+def write_summary(path, summaries):
+    with open(path, "w") as f:
+        f.write("song\tsegments\tseconds\terrors\tfirst_error\n")
+        for summary in summaries:
+            first_error = summary["errors"][0].replace("\t", " ").replace("\n", " ") if summary["errors"] else ""
+            f.write("%s\t%d\t%.2f\t%d\t%s\n" % (summary["song"], summary["segments"], summary["seconds"],
+                                               len(summary["errors"]), first_error))
+
+def record_finished(ledger, summaries, open_shard):
+    still_open = []
+    for summary in summaries:
+        if open_shard is not None and open_shard in summary["outputs"]:
+            still_open.append(summary)
+        else:
+            ledger.record(summary["mixture"], summary["stage"], summary["outputs"], summary["duration"])
+    return still_open
+
+if __name__ == "__main__":
+    ledger = JobLedger(ledger_file)
+    os.makedirs(os.path.join(dump_folder, "vocals"), exist_ok=True)
+    os.makedirs(os.path.join(dump_folder, "mixtures"), exist_ok=True)
+
+    # VAD segments, as written by separate.py (or "python vad.py build <source_folder>" for older dumps).
+    songs, segments = load_table(os.path.join(source_folder, CORPUS_TABLE_NAME))
+
+    tasks = []
+    for song, song_segments in song_slices(segments):
+        song_dir = str(songs[song])
+        song_id = song_dir.split("_")[0]
+        corresponding_log = os.path.join(logs_folder, song_id + ".log")
+        # here, it uses the logs file during download to determine if the file is spoof or bonafide.
+        spoof = 0
+        with open(corresponding_log, "r") as f:
+            curr_lines = f.readlines()
+            if curr_lines[4].strip() == "spoof":
+                spoof = 1
+            # this tag is directly written in file name!
+            # dataloaders in models/(model) also adhere to this logic.
+            mixture_file_name = curr_lines[0].strip() + ".flac"
+        mixture_file = os.path.join(logs_folder, mixture_file_name)
+        # segment boundaries are stored in samples at VAD_SR
+        starts = song_segments["start"] * output_sr // VAD_SR
+        ends = song_segments["end"] * output_sr // VAD_SR
+        stage = split_stage(starts, ends)
+        if ledger.is_done(mixture_file, stage):
+            continue
+        tasks.append((song_dir, song_id, spoof, mixture_file, starts, ends, stage))
+
+    summaries, unrecorded = [], []
+    shard_writer = ShardWriter(os.path.join(dump_folder, "shards"), SHARD_SIZE) if output_mode == "shards" else None
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        if shard_writer is not None:
+            # in task order, so shard contents are the same from run to run
+            results = executor.map(render_song, tasks)
+        else:
+            results = (future.result() for future in as_completed([executor.submit(render_song, task) for task in tasks]))
+        for summary in tqdm(results, total=len(tasks), desc="Rendering Splits"):
+            if shard_writer is not None and len(summary["errors"]) == 0:
+                for key, vocals, mixture, metadata in summary["samples"]:
+                    shard_path = shard_writer.write(key, vocals, mixture, metadata)
+                    if shard_path not in summary["outputs"]:
+                        summary["outputs"].append(shard_path)
+            summary["samples"] = []
+            summaries.append(summary)
+            # songs with errors are not recorded, so the next run retries them
+            if len(summary["errors"]) == 0:
+                unrecorded.append(summary)
+            # a song written to shards only counts as done once all of its shards are closed
+            unrecorded = record_finished(ledger, unrecorded, shard_writer.path if shard_writer is not None else None)
+
+    if shard_writer is not None:
+        shard_writer.close()
+        record_finished(ledger, unrecorded, None)
+    summaries.sort(key=lambda summary: summary["song"])
+    write_summary(summary_file, summaries)
+    failed = sum(1 for summary in summaries if len(summary["errors"]) > 0)
+    print("Rendered %d segments (%.1f hours) from %d songs, %d songs with errors, see %s" % (
+        sum(summary["segments"] for summary in summaries), sum(summary["seconds"] for summary in summaries) / 3600,
+        len(summaries), failed, summary_file))
@@ -0,0 +1,406 @@
+import os, json, itertools, argparse
+import numpy as np
+
+# VAD segments are kept as a structured NumPy table instead of stringified pyannote Annotations.
+# start/end are sample indices at VAD_SR, song indexes into the table's song name list,
+# confidence is the mean segmentation score inside the segment (NaN when unknown).
+
+VAD_SR = 16000
+
+SEGMENT_DTYPE = np.dtype([("song", "<i4"), ("track", "<i2"), ("start", "<i8"), ("end", "<i8"),
+                          ("confidence", "<f4")])
+
+SONG_SEGMENTS_NAME = "vocals.segments.npy" # per-song table, written next to vocals.wav
+CORPUS_TABLE_NAME = "vad_segments.npz" # one table per corpus
+SCORES_NAME = "vocals.scores.npy" # cached frame-level segmentation scores (float16)
+SCORES_TIMING_NAME = "vocals.scores.json" # sliding window the scores were computed on
+
+BACKENDS = ["pyannote", "energy"]
+
+# energy backend: analysis frames, and the hop the scores are computed on
+ENERGY_FRAME = 0.032
+ENERGY_HOP = 0.010
+ENERGY_SMOOTHING = 0.2
+ENERGY_CHUNK_FRAMES = 4096
+
+
+def song_file(name, backend="pyannote"):
+    # pyannote keeps the original file names, other backends write their own files next to them,
+    # so the outputs of two backends can be compared on the same song.
+    if backend == "pyannote":
+        return name
+    return name.replace("vocals.", "vocals.%s." % backend, 1)
+
+
+def empty_segments(n=0):
+    return np.zeros(n, dtype=SEGMENT_DTYPE)
+
+
+def save_scores(song_dir, scores, frame_start, frame_step, frame_duration, backend="pyannote"):
+    """
+    Caches frame-level scores of one song as a float16 .npy, so thresholds can be re-tuned
+    later without running the segmentation model again.
+    """
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    cache = np.lib.format.open_memmap(os.path.join(song_dir, song_file(SCORES_NAME, backend)), mode="w+", dtype=np.float16, shape=scores.shape)
+    cache[:] = scores
+    cache.flush()
+    del cache
+    with open(os.path.join(song_dir, song_file(SCORES_TIMING_NAME, backend)), "w") as f:
+        json.dump({"start": frame_start, "step": frame_step, "duration": frame_duration}, f)
+
+
+def load_scores(song_dir, backend="pyannote"):
+    """
+    Returns (scores, timing) where scores is a read-only float16 memmap.
+    """
+    with open(os.path.join(song_dir, song_file(SCORES_TIMING_NAME, backend)), "r") as f:
+        timing = json.load(f)
+    return np.load(os.path.join(song_dir, song_file(SCORES_NAME, backend)), mmap_mode="r"), timing
+
+
+def binarize(scores, timing, onset=0.5, offset=0.5, min_duration_on=0.0, min_duration_off=0.0, song=-1):
+    """
+    Vectorized equivalent of pyannote.audio.utils.signal.Binarize (without padding) on one score track.
+    A region starts at the first frame above onset and ends at the first following frame below offset;
+    gaps shorter than min_duration_off are filled, then regions shorter than min_duration_on are removed.
+    Frame times are the middles of the sliding window frames, as in pyannote.
+    """
+    if onset < offset:
+        raise ValueError("onset must not be lower than offset")
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    num_frames = len(scores)
+    if num_frames == 0:
+        return empty_segments()
+    frame_times = timing["start"] + timing["duration"] / 2 + timing["step"] * np.arange(num_frames)
+
+    # hysteresis: the state of a frame is given by the last frame that crossed a threshold
+    events = np.full(num_frames, -1, dtype=np.int8)
+    events[scores < offset] = 0
+    events[scores > onset] = 1
+    last_event = np.maximum.accumulate(np.where(events >= 0, np.arange(num_frames), -1))
+    active = np.where(last_event >= 0, events[last_event], 0).astype(np.int8)
+
+    changes = np.diff(active, prepend=0)
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    if len(ends) < len(starts):
+        ends = np.append(ends, num_frames - 1)
+
+    if min_duration_off > 0 and len(starts) > 1:
+        gaps = frame_times[starts[1:]] - frame_times[ends[:-1]]
+        keep = gaps >= min_duration_off
+        starts = starts[np.r_[True, keep]]
+        ends = ends[np.r_[keep, True]]
+
+    if min_duration_on > 0:
+        keep = frame_times[ends] - frame_times[starts] >= min_duration_on
+        starts, ends = starts[keep], ends[keep]
+
+    table = empty_segments(len(starts))
+    table["song"] = song
+    table["track"] = np.arange(len(starts))
+    table["start"] = np.round(frame_times[starts] * VAD_SR).astype(np.int64)
+    table["end"] = np.round(frame_times[ends] * VAD_SR).astype(np.int64)
+    # mean score of the frames inside each region
+    cumulative = np.concatenate([[0.0], np.cumsum(scores, dtype=np.float64)])
+    table["confidence"] = (cumulative[ends] - cumulative[starts]) / np.maximum(ends - starts, 1)
+    return table
+
+
+def _moving_average(x, width):
+    if width <= 1:
+        return x
+    kernel = np.ones(width, dtype=np.float32) / width
+    return np.convolve(x, kernel, mode="same")
+
+
+def energy_scores(wave, sr):
+    """
+    Frame scores in [0, 1] for a separated vocal stem from frame energy and spectral flux,
+    computed without any model. Returns (scores, timing) in the same form as the cached
+    pyannote scores, so both go through binarize.
+
+    wave: (samples,) or (channels, samples) float array
+    """
+    wave = np.asarray(wave, dtype=np.float32)
+    if wave.ndim > 1:
+        wave = wave.mean(axis=0)
+    frame_len = int(round(ENERGY_FRAME * sr))
+    hop = int(round(ENERGY_HOP * sr))
+    n_fft = 1 << int(np.ceil(np.log2(frame_len)))
+    if len(wave) < frame_len:
+        wave = np.pad(wave, (0, frame_len - len(wave)))
+    frames = np.lib.stride_tricks.sliding_window_view(wave, frame_len)[::hop]
+    window = np.hanning(frame_len).astype(np.float32)
+
+    num_frames = len(frames)
+    log_energy = np.empty(num_frames, dtype=np.float32)
+    flux = np.empty(num_frames, dtype=np.float32)
+    previous = None
+    # chunked so the spectra of a long song never sit in memory at once
+    for begin in range(0, num_frames, ENERGY_CHUNK_FRAMES):
+        chunk = frames[begin:begin + ENERGY_CHUNK_FRAMES]
+        log_energy[begin:begin + len(chunk)] = 10 * np.log10(np.mean(chunk ** 2, axis=1) + 1e-10)
+        magnitude = np.log1p(np.abs(np.fft.rfft(chunk * window, n=n_fft, axis=1)))
+        if previous is None:
+            previous = magnitude[:1]
+        diff = np.diff(np.concatenate([previous, magnitude]), axis=0)
+        flux[begin:begin + len(chunk)] = np.maximum(diff, 0).mean(axis=1)
+        previous = magnitude[-1:]
+
+    # energy relative to the song's own floor and ceiling, since stems differ a lot in level
+    floor, ceiling = np.percentile(log_energy, [10, 95])
+    energy_score = np.clip((log_energy - floor) / max(ceiling - floor, 1e-3), 0, 1)
+    flux_score = np.clip(flux / max(np.percentile(flux, 95), 1e-6), 0, 1)
+    scores = 0.7 * energy_score + 0.3 * flux_score
+    scores = _moving_average(scores, int(round(ENERGY_SMOOTHING / ENERGY_HOP)))
+    timing = {"start": 0.0, "step": hop / sr, "duration": frame_len / sr}
+    return scores.astype(np.float32), timing
+
+
+def _activity_mask(segments, num_samples, resolution):
+    # rasterizes a segment table to a boolean activity mask with one entry per `resolution` samples
+    mask = np.zeros(num_samples // resolution + 2, dtype=np.int32)
+    np.add.at(mask, segments["start"] // resolution, 1)
+    np.add.at(mask, segments["end"] // resolution, -1)
+    return np.cumsum(mask)[:-1] > 0
+
+
+def segment_iou(segments_a, segments_b, resolution=160):
+    """
+    Returns (intersection, union) of two segment tables, in samples at VAD_SR (10 ms resolution).
+    """
+    if len(segments_a) == 0 and len(segments_b) == 0:
+        return 0, 0
+    num_samples = int(max(segments_a["end"].max(initial=0), segments_b["end"].max(initial=0)))
+    mask_a = _activity_mask(segments_a, num_samples, resolution)
+    mask_b = _activity_mask(segments_b, num_samples, resolution)
+    return int((mask_a & mask_b).sum()) * resolution, int((mask_a | mask_b).sum()) * resolution
+
+
+def _format_time(samples):
+    # same layout as pyannote.core.Segment.__str__
+    seconds = samples / VAD_SR
+    h = int(seconds // 3600)
+    m = int((seconds % 3600) // 60)
+    s = seconds % 60
+    return " %02d:%02d:%06.3f" % (h, m, s)
+
+
+def to_legacy(segments, label="SPEECH"):
+    """
+    Renders a segment table in the text layout of str(Annotation), i.e. the old *.vad files.
+    """
+    lines = []
+    for row in segments:
+        lines.append("[%s --> %s] %d %s" % (_format_time(row["start"]), _format_time(row["end"]), row["track"], label))
+    return "\n".join(lines)
+
+
+def _parse_time(text):
+    h, m, s = text.strip().split(":")
+    return float(h) * 3600.0 + float(m) * 60.0 + float(s)
+
+
+def from_legacy(text, song=-1):
+    """
+    Parses an old *.vad file, so existing dumps can be converted once instead of re-running VAD.
+    """
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "":
+            continue
+        start, end = line.split("]")[0].split("[")[1].split("-->")
+        rows.append((song, len(rows), int(round(_parse_time(start) * VAD_SR)), int(round(_parse_time(end) * VAD_SR)), np.nan))
+    return np.array(rows, dtype=SEGMENT_DTYPE)
+
+
+def save_song_segments(path, segments):
+    np.save(path, segments, allow_pickle=False)
+
+
+def load_song_segments(path):
+    return np.load(path, allow_pickle=False)
+
+
+def save_table(path, songs, segments):
+    order = np.lexsort((segments["start"], segments["song"]))
+    np.savez(path, songs=np.asarray(songs, dtype=np.str_), segments=segments[order])
+
+
+def load_table(path):
+    """
+    Returns (songs, segments). songs is an array of song folder names, segments["song"] indexes it.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return data["songs"], data["segments"]
+
+
+def song_slices(segments):
+    """
+    Yields (song, segments of that song) from a table sorted by song.
+    """
+    if len(segments) == 0:
+        return
+    boundaries = np.flatnonzero(np.diff(segments["song"])) + 1
+    for chunk in np.split(segments, boundaries):
+        yield int(chunk["song"][0]), chunk
+
+
+def build_table(source_folder, table_path=None, backend="pyannote"):
+    """
+    Gathers the per-song segment files under source_folder into one corpus table.
+    Songs that only have a legacy *.vad file are converted on the way (pyannote backend only).
+    """
+    songs, tables = [], []
+    for song in sorted(os.listdir(source_folder)):
+        song_dir = os.path.join(source_folder, song)
+        if not os.path.isdir(song_dir):
+            continue
+        segments_path = os.path.join(song_dir, song_file(SONG_SEGMENTS_NAME, backend))
+        legacy_path = os.path.join(song_dir, "vocals.vad")
+        if os.path.exists(segments_path):
+            segments = load_song_segments(segments_path)
+        elif backend == "pyannote" and os.path.exists(legacy_path):
+            with open(legacy_path, "r") as f:
+                segments = from_legacy(f.read())
+        else:
+            continue
+        segments = segments.copy()
+        segments["song"] = len(songs)
+        songs.append(song)
+        tables.append(segments)
+    segments = np.concatenate(tables) if len(tables) > 0 else empty_segments()
+    if table_path is None:
+        table_path = os.path.join(source_folder, CORPUS_TABLE_NAME)
+    save_table(table_path, songs, segments)
+    return songs, segments
+
+
+def export_legacy(table_path, source_folder):
+    songs, segments = load_table(table_path)
+    for song, chunk in song_slices(segments):
+        with open(os.path.join(source_folder, songs[song], "vocals.vad"), "w") as f:
+            f.write(to_legacy(chunk))
+
+
+def rebinarize(source_folder, hyper_parameters, table_path=None, backend="pyannote"):
+    """
+    Re-derives every song's segments from the cached scores with new thresholds.
+    """
+    for song in sorted(os.listdir(source_folder)):
+        song_dir = os.path.join(source_folder, song)
+        if os.path.exists(os.path.join(song_dir, song_file(SCORES_NAME, backend))):
+            scores, timing = load_scores(song_dir, backend)
+            save_song_segments(os.path.join(song_dir, song_file(SONG_SEGMENTS_NAME, backend)),
+                               binarize(scores, timing, **hyper_parameters))
+    return build_table(source_folder, table_path, backend)
+
+
+def agreement(source_folder, backend_a="energy", backend_b="pyannote"):
+    """
+    Per-song IoU between the segments of two backends, for every song where both exist.
+    Returns a list of (song, intersection, union) in samples at VAD_SR.
+    """
+    rows = []
+    for song in sorted(os.listdir(source_folder)):
+        song_dir = os.path.join(source_folder, song)
+        path_a = os.path.join(song_dir, song_file(SONG_SEGMENTS_NAME, backend_a))
+        path_b = os.path.join(song_dir, song_file(SONG_SEGMENTS_NAME, backend_b))
+        if os.path.exists(path_a) and os.path.exists(path_b):
+            intersection, union = segment_iou(load_song_segments(path_a), load_song_segments(path_b))
+            rows.append((song, intersection, union))
+    return rows
+
+
+def sweep(source_folder, grid, backend="pyannote"):
+    """
+    Binarizes the cached scores of every song with each combination in grid
+    (a dict of hyper-parameter name -> list of values) and returns one result row per setting.
+    """
+    cached = []
+    for song in sorted(os.listdir(source_folder)):
+        song_dir = os.path.join(source_folder, song)
+        if os.path.exists(os.path.join(song_dir, song_file(SCORES_NAME, backend))):
+            scores, timing = load_scores(song_dir, backend)
+            cached.append((np.asarray(scores, dtype=np.float32), timing))
+
+    names = list(grid.keys())
+    results = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        hyper_parameters = dict(zip(names, values))
+        if hyper_parameters.get("onset", 0.5) < hyper_parameters.get("offset", 0.5):
+            continue
+        num_segments, retained = 0, 0
+        for scores, timing in cached:
+            segments = binarize(scores, timing, **hyper_parameters)
+            num_segments += len(segments)
+            retained += int((segments["end"] - segments["start"]).sum())
+        results.append(dict(hyper_parameters, songs=len(cached), segments=num_segments, hours=retained / VAD_SR / 3600))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and inspect VAD segment tables.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="gather per-song segments (or legacy *.vad files) into one table")
+    build_parser.add_argument("source_folder", type=str, help="separated stems folder, e.g. ./mdx_extra")
+    build_parser.add_argument("--table", type=str, default=None, help="output table (default: <source_folder>/" + CORPUS_TABLE_NAME + ")")
+    build_parser.add_argument("--backend", type=str, default="pyannote", choices=BACKENDS)
+    legacy_parser = subparsers.add_parser("legacy", help="write legacy *.vad text files from a table")
+    legacy_parser.add_argument("table", type=str)
+    legacy_parser.add_argument("source_folder", type=str)
+    sweep_parser = subparsers.add_parser("sweep", help="report segment counts and retained duration over a threshold grid")
+    sweep_parser.add_argument("source_folder", type=str)
+    sweep_parser.add_argument("--backend", type=str, default="pyannote", choices=BACKENDS)
+    sweep_parser.add_argument("--onset", type=float, nargs="+", default=[0.5])
+    sweep_parser.add_argument("--offset", type=float, nargs="+", default=[0.5])
+    sweep_parser.add_argument("--min_duration_on", type=float, nargs="+", default=[3.0])
+    sweep_parser.add_argument("--min_duration_off", type=float, nargs="+", default=[0.0])
+    binarize_parser = subparsers.add_parser("binarize", help="rewrite all segments from the cached scores with new thresholds")
+    binarize_parser.add_argument("source_folder", type=str)
+    binarize_parser.add_argument("--backend", type=str, default="pyannote", choices=BACKENDS)
+    binarize_parser.add_argument("--onset", type=float, default=0.5)
+    binarize_parser.add_argument("--offset", type=float, default=0.5)
+    binarize_parser.add_argument("--min_duration_on", type=float, default=3.0)
+    binarize_parser.add_argument("--min_duration_off", type=float, default=0.0)
+    binarize_parser.add_argument("--table", type=str, default=None)
+    agreement_parser = subparsers.add_parser("agreement", help="IoU between the segments of two backends")
+    agreement_parser.add_argument("source_folder", type=str)
+    agreement_parser.add_argument("--backends", type=str, nargs=2, default=["energy", "pyannote"], choices=BACKENDS)
+    agreement_parser.add_argument("--verbose", action="store_true", help="print every song")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        songs, segments = build_table(args.source_folder, args.table, args.backend)
+        print("%d songs, %d segments, %.1f hours of vocals" % (
+            len(songs), len(segments), (segments["end"] - segments["start"]).sum() / VAD_SR / 3600))
+    elif args.command == "legacy":
+        export_legacy(args.table, args.source_folder)
+    elif args.command == "sweep":
+        grid = {"onset": args.onset, "offset": args.offset,
+                "min_duration_on": args.min_duration_on, "min_duration_off": args.min_duration_off}
+        columns = list(grid.keys()) + ["songs", "segments", "hours"]
+        print("\t".join(columns))
+        for row in sweep(args.source_folder, grid, args.backend):
+            print("\t".join("%.2f" % row[c] if isinstance(row[c], float) else str(row[c]) for c in columns))
+    elif args.command == "binarize":
+        hyper_parameters = {"onset": args.onset, "offset": args.offset,
+                            "min_duration_on": args.min_duration_on, "min_duration_off": args.min_duration_off}
+        songs, segments = rebinarize(args.source_folder, hyper_parameters, args.table, args.backend)
+        print("%d songs, %d segments, %.1f hours of vocals" % (
+            len(songs), len(segments), (segments["end"] - segments["start"]).sum() / VAD_SR / 3600))
+    elif args.command == "agreement":
+        rows = agreement(args.source_folder, *args.backends)
+        if args.verbose:
+            for song, intersection, union in rows:
+                print("%s\t%.3f" % (song, intersection / union if union > 0 else 1.0))
+        ious = np.array([intersection / union if union > 0 else 1.0 for _, intersection, union in rows])
+        total_intersection = sum(row[1] for row in rows)
+        total_union = sum(row[2] for row in rows)
+        print("%d songs with both %s and %s segments" % (len(rows), *args.backends))
+        if len(rows) > 0:
+            print("mean IoU %.3f, median IoU %.3f, pooled IoU %.3f" % (
+                ious.mean(), np.median(ious), total_intersection / max(total_union, 1)))
@@ -0,0 +1,170 @@
+import os
+import io
+import shutil
+import hashlib
+import subprocess
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# The T03 codec configurations materialized by dataset/simulate_codec.py.
+CODECS = [("mp3", "128k"), ("ogg", "64k"), ("adts", "64k"), ("opus", "64k")]
+
+ENCODERS = {"mp3": "libmp3lame", "ogg": "libvorbis", "adts": "aac", "opus": "libopus"}
+
+
+def parse_bitrate(bitrate):
+    bitrate = str(bitrate).lower()
+    if bitrate.endswith("k"):
+        return int(float(bitrate[:-1]) * 1000)
+    return int(bitrate)
+
+
+def can_encode(format):
+    if av is None:
+        return False
+    try:
+        av.codec.Codec(ENCODERS[format], "w")
+    except Exception:
+        return False
+    return True
+
+
+def encode(x, sr, format, bitrate):
+    """
+    Encodes a mono float32 signal into `format` and returns the encoded bytes. Runs in-process with
+    PyAV when it has the encoder, otherwise pipes the samples through ffmpeg.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    if not can_encode(format):
+        return subprocess.run(["ffmpeg", "-v", "error", "-f", "f32le", "-ar", str(sr), "-ac", "1", "-i", "pipe:0",
+                               "-acodec", ENCODERS[format], "-b:a", bitrate, "-f", format, "pipe:1"],
+                              input=x.tobytes(), capture_output=True, check=True).stdout
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format=format) as container:
+        # opus only encodes at 48 kHz, the encoder resamples the frame itself
+        stream = container.add_stream(ENCODERS[format], rate=48000 if format == "opus" else sr)
+        stream.bit_rate = parse_bitrate(bitrate)
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(x[None], format="fltp", layout="mono")
+        frame.sample_rate = sr
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def decode(data, sr):
+    """
+    Decodes encoded bytes back to a mono float32 signal at sr.
+    """
+    if av is None:
+        decoded = subprocess.run(["ffmpeg", "-v", "error", "-i", "pipe:0", "-f", "f32le", "-ar", str(sr), "-ac", "1",
+                                  "pipe:1"], input=data, capture_output=True, check=True).stdout
+        return np.frombuffer(decoded, dtype=np.float32)
+    resampler = av.AudioResampler(format="fltp", layout="mono", rate=sr)
+    chunks = []
+    with av.open(io.BytesIO(data), "r") as container:
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray()[0])
+    for out in resampler.resample(None):
+        chunks.append(out.to_ndarray()[0])
+    return np.concatenate(chunks)
+
+
+class CodecAugment:
+    """
+    Round-trips a training crop through a randomly chosen codec configuration with probability p.
+    Crop starts are snapped to a grid of `grid` seconds, so the same (file, crop, codec) comes back
+    across epochs and its encoded bytes can be served from cache_dir instead of being encoded again.
+    The cache is shared by all DataLoader workers and bounded to max_cache_bytes; the least recently
+    used entries (by mtime, refreshed on every hit) are removed first.
+    """
+    def __init__(self, codecs=CODECS, p=0.5, sr=16000, grid=0.5, cache_dir=None, max_cache_bytes=4 << 30):
+        has_ffmpeg = shutil.which("ffmpeg") is not None
+        self.codecs = [(f, b) for f, b in codecs if can_encode(f) or has_ffmpeg]
+        for f, b in codecs:
+            if (f, b) not in self.codecs:
+                print(f"CodecAugment: no encoder for {f}, skipping {f}_{b}")
+        self.p = p if len(self.codecs) > 0 else 0.0
+        self.sr = sr
+        self.grid = max(1, int(grid * sr))
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.written = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def crop(self, x, max_len):
+        """
+        Same as pad_random, but the crop start is a multiple of the grid. Returns (crop, start).
+        """
+        x_len = x.shape[0]
+        if x_len >= max_len:
+            stt = np.random.randint((x_len - max_len) // self.grid + 1) * self.grid
+            return x[stt:stt + max_len], stt
+        num_repeats = int(max_len / x_len) + 1
+        return np.tile(x, (num_repeats))[:max_len], 0
+
+    def __call__(self, x, key):
+        """
+        x is a mono crop, key identifies it, e.g. (file path, channel, crop start).
+        """
+        if self.p <= 0 or np.random.rand() >= self.p:
+            return x
+        format, bitrate = self.codecs[np.random.randint(len(self.codecs))]
+        data = self._cached(key, len(x), format, bitrate, x)
+        y = decode(data, self.sr)
+        # codec delay and frame padding change the length, keep the crop length
+        if len(y) >= len(x):
+            return y[:len(x)]
+        return np.pad(y, (0, len(x) - len(y)))
+
+    def _cached(self, key, length, format, bitrate, x):
+        if self.cache_dir is None:
+            return encode(x, self.sr, format, bitrate)
+        name = hashlib.blake2b(repr((key, length, self.sr, format, bitrate)).encode("utf-8"), digest_size=16).hexdigest()
+        path = os.path.join(self.cache_dir, name + "." + format)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            pass
+        data = encode(x, self.sr, format, bitrate)
+        # write then rename, so other workers never read a partial file
+        tmp_path = path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.written += len(data)
+        if self.written > self.max_cache_bytes // 20:
+            self.evict()
+        return data
+
+    def evict(self):
+        self.written = 0
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
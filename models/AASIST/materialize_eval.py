@@ -0,0 +1,97 @@
+import os
+import argparse
+import numpy as np
+import librosa
+from concurrent.futures import ProcessPoolExecutor
+from data_utils import Dataset_SingFake, materialized_paths, pad_random
+
+# Fixes the evaluation crops of dev/test splits once, for Dataset_SingFakeEval ("materialized_eval" in
+# AASIST.conf). Every clip gets `windows` crops, evenly spread over the clip (one window is centered),
+# of channel k % channels for window k, and repeat-padded when the clip is short. The crops are
+# normalized like in Dataset_SingFake and stored back to back as one float32 tensor:
+#   <split>/materialized/<folder>_audio_w<windows>.f32  (windows of all clips, samples)
+#   <split>/materialized/<folder>_audio_w<windows>.npz  shape, labels, clips (clip of every window),
+#                                                       starts, channels, paths/path_offsets (utf-8)
+# main.py evaluates dev, test, additional_test, persian_test and
+# codec_test/{mp3_128k,ogg_64k,adts_64k,opus_64k}; splits without these files are decoded as before.
+
+CUT = 64600 # Dataset_SingFake.cut
+
+
+def window_starts(length, cut, windows):
+    if length <= cut:
+        return [0] * windows
+    if windows == 1:
+        return [(length - cut) // 2]
+    return [round(k * (length - cut) / (windows - 1)) for k in range(windows)]
+
+
+def materialize_clip(path, windows, target_sr=16000):
+    """
+    Returns (crops, starts, channels) of one clip, or None if it cannot be decoded.
+    """
+    try:
+        X, _ = librosa.load(path, sr=target_sr, mono=False)
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return None
+    if X.ndim == 1:
+        X = X[None]
+    starts = window_starts(X.shape[1], CUT, windows)
+    channels = [k % X.shape[0] for k in range(windows)]
+    crops = []
+    for start, channel_id in zip(starts, channels):
+        x = X[channel_id]
+        X_pad = x[start:start + CUT] if len(x) >= CUT else pad_random(x, CUT)
+        crops.append(X_pad / np.max(np.abs(X_pad)))
+    return np.stack(crops).astype(np.float32), starts, channels
+
+
+def _materialize_task(task):
+    return materialize_clip(*task)
+
+
+def materialize(base_dir, is_mixture=False, windows=1, max_workers=None):
+    tensor_path, index_path = materialized_paths(base_dir, is_mixture, "audio", windows)
+    os.makedirs(os.path.dirname(tensor_path), exist_ok=True)
+    dataset = Dataset_SingFake(base_dir, is_mixture)
+    clips = [dataset._file(i) for i in range(len(dataset))]
+
+    shape, labels, clip_ids, starts, channels, kept = None, [], [], [], [], []
+    tmp_path = tensor_path + ".tmp"
+    with open(tmp_path, "wb") as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_materialize_task, [(path, windows) for path, _ in clips], chunksize=8)
+        for (path, label), result in zip(clips, results):
+            if result is None:
+                continue
+            crops, clip_starts, clip_channels = result
+            shape = crops.shape[1:]
+            f.write(crops.tobytes())
+            labels += [label] * windows
+            clip_ids += [len(kept)] * windows
+            starts += clip_starts
+            channels += clip_channels
+            kept.append(os.path.relpath(path, base_dir).encode("utf-8"))
+    os.replace(tmp_path, tensor_path)
+
+    path_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in kept], out=path_offsets[1:])
+    with open(index_path, "wb") as f:
+        np.savez(f, shape=np.asarray(shape or (0,), dtype=np.int64), labels=np.asarray(labels, dtype=np.int8),
+                 clips=np.asarray(clip_ids, dtype=np.int32), starts=np.asarray(starts, dtype=np.int64),
+                 channels=np.asarray(channels, dtype=np.int8),
+                 paths=np.frombuffer(b"".join(kept), dtype=np.uint8), path_offsets=path_offsets)
+    return len(labels), len(clips) - len(kept), os.path.getsize(tensor_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write fixed evaluation crops of dev/test splits as one tensor.")
+    parser.add_argument("splits", type=str, nargs="+", help="split folders, e.g. <dataset>/dev <dataset>/test")
+    parser.add_argument('--is_mixture', action='store_true')
+    parser.add_argument('--windows', type=int, default=1, help="crops per clip")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for split in args.splits:
+        count, failed, size = materialize(split, args.is_mixture, args.windows, args.workers)
+        print("%s: %d windows (%d clips failed), %.2f GB" % (split, count, failed, size / (1 << 30)))
@@ -0,0 +1,49 @@
+import math
+import numpy as np
+import soundfile as sf
+import soxr
+
+
+# Decoding for the ASVspoof-style datasets, with the output of librosa.load (+ librosa.util.normalize)
+# but less work: soundfile reads float32 directly (its default is float64), files already at the
+# target rate are not resampled, other rates go straight to soxr (the soxr_hq resampler librosa.load
+# uses), and normalization happens in the decoded buffer.
+
+
+def resample(x, orig_sr, target_sr):
+    """
+    librosa.resample(x, orig_sr=orig_sr, target_sr=target_sr) of a mono signal.
+    """
+    if orig_sr == target_sr:
+        return x
+    y = soxr.resample(x, orig_sr, target_sr, quality="soxr_hq")
+    # librosa trims or pads to this length
+    n = int(math.ceil(len(x) * target_sr / orig_sr))
+    if len(y) < n:
+        y = np.pad(y, (0, n - len(y)))
+    return np.ascontiguousarray(y[:n], dtype=np.float32)
+
+
+def normalize_(x):
+    """
+    librosa.util.normalize of a mono signal, in place: scales it to a peak of 1.
+    """
+    peak = np.max(np.abs(x)) if x.size > 0 else 0.0
+    if peak >= np.finfo(x.dtype).tiny:
+        x /= peak
+    return x
+
+
+def load_audio(path, target_sr=16000, normalize=False):
+    """
+    Decodes path as mono float32 at target_sr (None keeps the file's rate), like librosa.load.
+    Returns (x, sr).
+    """
+    x, sr = sf.read(path, dtype="float32", always_2d=True)
+    # (samples, 1) -> (samples,) is a view; librosa.to_mono averages the channels
+    x = x[:, 0] if x.shape[1] == 1 else x.mean(axis=1)
+    if target_sr is not None and sr != target_sr:
+        x, sr = resample(x, sr, target_sr), target_sr
+    if normalize:
+        normalize_(x)
+    return x, sr
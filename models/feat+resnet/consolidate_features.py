@@ -0,0 +1,70 @@
+import os
+import argparse
+import numpy as np
+import torch
+import librosa
+from concurrent.futures import ProcessPoolExecutor
+from dataset import feature_store_paths
+
+# Packs a folder of per-utterance .pt features (preprocess.py output, e.g. ASVspoof2019LA/train/LFCC)
+# into one FeatureStore, read by ASVspoof2019LA, VCC2020 and ASVspoof2015 with use_store=True:
+#   <folder>.store      all tensors back to back, frame by frame (float32, or float16 with --float16)
+#   <folder>.store.npz  offsets and lengths (frames), row_shape, dtype, names/name_offsets (utf-8,
+#                       relative to the folder) and the tag and label fields of the file names
+# Files are listed like the datasets do (librosa.util.find_files), so the order is the same.
+
+
+def load_feature(path):
+    # preprocess.py may have saved CUDA tensors
+    return torch.load(path, map_location="cpu")[0].numpy()
+
+
+def save_store_index(index_path, offsets, lengths, row_shape, dtype, names, tags, labels):
+    encoded = [name.encode("utf-8") for name in names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, offsets=np.asarray(offsets, dtype=np.int64), lengths=np.asarray(lengths, dtype=np.int32),
+                 row_shape=np.asarray(row_shape or (), dtype=np.int64), dtype=np.str_(np.dtype(dtype).name),
+                 names=np.frombuffer(b"".join(encoded), dtype=np.uint8), name_offsets=name_offsets,
+                 tags=np.asarray(tags, dtype=np.str_), labels=np.asarray(labels, dtype=np.str_))
+    os.replace(tmp_path, index_path)
+
+
+def consolidate(feature_dir, dtype=np.float32, max_workers=None):
+    files = librosa.util.find_files(feature_dir, ext="pt")
+    data_path, index_path = feature_store_paths(feature_dir)
+    offsets, lengths, names, tags, labels = [], [], [], [], []
+    row_shape = None
+    rows = 0
+    tmp_path = data_path + ".tmp"
+    with open(tmp_path, "wb") as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for path, feature in zip(files, executor.map(load_feature, files, chunksize=64)):
+            if row_shape is None:
+                row_shape = feature.shape[1:]
+            assert feature.shape[1:] == row_shape, f"{path}: {feature.shape} does not match {row_shape}"
+            f.write(np.ascontiguousarray(feature, dtype=dtype).tobytes())
+            offsets.append(rows)
+            lengths.append(len(feature))
+            rows += len(feature)
+            names.append(os.path.relpath(path, feature_dir))
+            # <...>_<tag>_<label>.pt
+            all_info = os.path.basename(path).split(".")[0].split("_")
+            tags.append(all_info[-2])
+            labels.append(all_info[-1])
+    os.replace(tmp_path, data_path)
+    save_store_index(index_path, offsets, lengths, row_shape, dtype, names, tags, labels)
+    return len(files), rows, os.path.getsize(data_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack folders of per-utterance .pt features into one memmap each.")
+    parser.add_argument("feature_dirs", type=str, nargs="+", help="e.g. /data2/neil/ASVspoof2019LA/train/LFCC")
+    parser.add_argument('--float16', action='store_true', help="store float16 instead of float32")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    for feature_dir in args.feature_dirs:
+        count, rows, size = consolidate(feature_dir, np.float16 if args.float16 else np.float32, args.workers)
+        print("%s: %d files, %d frames, %.2f GB" % (feature_dir, count, rows, size / (1 << 30)))
@@ -3,18 +3,26 @@
 import numpy as np
 import torch
 from torch import Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
 import pickle
 import os
+import math
+import io
+import json
+import random
+import hashlib
+import tarfile
 import librosa
+import soundfile as sf
 from torch.utils.data.dataloader import default_collate
 import torchaudio
 from audio_feature_extraction import LFCC
+from codec_augment import CodecAugment
 
 
 class ASVspoof2019LA(Dataset):
     def __init__(self, path_to_audio='/data/neil/DS_10283_3336/', path_to_features='/data2/neil/ASVspoof2019LA/',
-                 part='train', feature='LFCC', feat_len=400, genuine_only=False):
+                 part='train', feature='LFCC', feat_len=400, genuine_only=False, use_store=False):
         super(ASVspoof2019LA, self).__init__()
         self.path_to_audio = path_to_audio
         self.path_to_features = path_to_features
@@ -27,7 +35,12 @@ class ASVspoof2019LA(Dataset):
                       "A10": 10, "A11": 11, "A12": 12, "A13": 13, "A14": 14, "A15": 15, "A16": 16, "A17": 17, "A18": 18,
                       "A19": 19}
         self.label = {"spoof": 1, "bonafide": 0}
-        self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
+        # use_store reads the .pt files from the FeatureStore written by consolidate_features.py
+        self.store = FeatureStore(os.path.join(self.ptf, self.feature)) if use_store else None
+        if self.store is not None:
+            self.all_files = self.store.files()
+        else:
+            self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
         if self.genuine_only:
             if self.part in ["train", "dev"]:
                 num_bonafide = {"train": 2580, "dev": 2548}
@@ -49,7 +62,7 @@ class ASVspoof2019LA(Dataset):
         all_info = basename.split(".")[0].split("_")
         filename = "_".join(all_info[1:4])
         if self.feature != "Raw":
-            featureTensor = torch.load(filepath)
+            featureTensor = torch.load(filepath) if self.store is None else self.store.load(filepath, self.feat_len)
             this_feat_len = featureTensor.shape[1]
             if this_feat_len > self.feat_len:
                 startp = np.random.randint(this_feat_len - self.feat_len)
@@ -59,7 +72,7 @@ class ASVspoof2019LA(Dataset):
         else:
             # file_path = os.path.join(self.path_to_audio, "LA/ASVspoof2019_LA_" + self.part, "flac", filename+".flac")
             # featureTensor, sr = torchaudio.load(file_path)
-            featureTensor = torch.load(filepath)
+            featureTensor = torch.load(filepath) if self.store is None else self.store.load(filepath, self.feat_len)
             this_feat_len = featureTensor.shape[1]
             if this_feat_len > self.feat_len:
                 startp = np.random.randint(this_feat_len - self.feat_len)
@@ -121,13 +134,31 @@ class ASVspoof2019LASpec(Dataset):
     
 
 class Dataset_SingFake(Dataset):
-    def __init__(self, base_dir, is_mixture=False, target_sr=16000):
+    def __init__(self, base_dir, is_mixture=False, target_sr=16000, codec_augment=None, manifest_filter=None,
+                 crops_per_clip=1, both_channels=False, clip_cache=None, raw_features=False):
         """
         base_dir should contain mixtures/ and vocals/ folders
+        codec_augment is an optional CodecAugment applied to every crop (training only)
+        manifest_filter are SplitManifest keyword arguments (labels, songs, min_duration, max_duration),
+        used when base_dir has an index.npz
+        crops_per_clip > 1 or both_channels make every item a stack of examples cut from one decode
+        (crops_per_clip crops, of one random channel or of both); load them with MultiCropBatchSampler
+        and flatten_collate
+        clip_cache is an optional SharedClipCache holding the decoded clips across epochs (dev/test sets);
+        clips are then decoded whole instead of only the crop window
+        raw_features returns the 16 kHz crops instead of their features, which are then computed per
+        batch with BatchFeature
         """
         self.base_dir = base_dir
         self.is_mixture = is_mixture
         self.target_sr = target_sr
+        self.codec_augment = codec_augment
+        self.crops_per_clip = crops_per_clip
+        self.both_channels = both_channels
+        self.clip_cache = clip_cache
+        self.raw_features = raw_features
+        # assumes stereo clips, which is what split.py writes
+        self.examples_per_clip = crops_per_clip * (2 if both_channels else 1)
         self.cut = 64000  # take 4 sec audio (64000 samples)
         
         # get file list
@@ -139,38 +170,422 @@ class Dataset_SingFake(Dataset):
         
         assert os.path.exists(self.target_path), f"{self.target_path} does not exist!"
         
-        for file in os.listdir(self.target_path):
-            if file.endswith(".flac"):
-                self.file_list.append(file[:-5])
+        self.manifest = None
+        if os.path.exists(os.path.join(self.base_dir, "index.npz")):
+            # audited by dataset/audit.py, corrupt and silent files are already left out
+            self.manifest = SplitManifest(self.base_dir, self.is_mixture, **(manifest_filter or {}))
+        else:
+            for file in os.listdir(self.target_path):
+                if file.endswith(".flac"):
+                    self.file_list.append(file[:-5])
 
         # self.lfcc = LFCC(320, 160, 512, 16000, 20, with_energy=False)
         self.spec = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=160, win_length=512, power=2, normalized=True)
     
     def __len__(self):
+        if self.manifest is not None:
+            return len(self.manifest)
         return len(self.file_list)
 
-    def __getitem__(self, index):
+    def _file(self, index):
+        if self.manifest is not None:
+            return self.manifest.path(index), int(self.manifest.labels[index])
         key = self.file_list[index]
-        file_path = os.path.join(self.target_path, key + ".flac")
+        return os.path.join(self.target_path, key + ".flac"), int(key.split("_")[0])
+
+    def _decode(self, file_path):
+        # librosa.load(mono=False), from the clip cache when there is one
+        X = self.clip_cache.get(file_path) if self.clip_cache is not None else None
+        if X is None:
+            X, _ = librosa.load(file_path, sr=self.target_sr, mono=False)
+            if self.clip_cache is not None:
+                self.clip_cache.put(file_path, X)
+        return X
+
+    def _multi_item(self, file_path, y, grid):
+        try:
+            if self.crops_per_clip == 1 and self.clip_cache is None:
+                # one crop of both channels, only the window is decoded
+                crop = load_random_crop(file_path, self.target_sr, self.cut, grid)
+            else:
+                crop = None
+            if crop is None:
+                X = self._decode(file_path)
+            else:
+                X, start = crop
+            X = librosa.util.normalize(X)
+        except:
+            print(f"Error loading {file_path}")
+            return self.__getitem__(np.random.randint(len(self)))
+        if X.ndim == 1:
+            X = X[None]
+        channels = range(X.shape[0]) if self.both_channels else [np.random.randint(X.shape[0])]
+        xs = []
+        for _ in range(self.crops_per_clip):
+            if crop is None:
+                X_crop, start = crop_channels(X, self.cut, grid)
+            else:
+                X_crop = X
+            for channel_id in channels:
+                X_pad = X_crop[channel_id]
+                if self.codec_augment is not None:
+                    X_pad = self.codec_augment(X_pad, (file_path, channel_id, start))
+                x_inp = Tensor(X_pad)
+                xs.append(x_inp if self.raw_features else self.spec(x_inp.unsqueeze(0)))
+        return torch.stack(xs), torch.full((len(xs),), y, dtype=torch.long)
+
+    def __getitem__(self, index):
+        file_path, y = self._file(index)
+        grid = self.codec_augment.grid if self.codec_augment is not None else 1
+        if self.examples_per_clip > 1:
+            return self._multi_item(file_path, y, grid)
         # X, _ = sf.read(file_path, samplerate=self.target_sr)
         try:
-            X, _ = librosa.load(file_path, sr=self.target_sr, mono=False)
+            # long clips: only the crop is decoded and resampled
+            crop = load_random_crop(file_path, self.target_sr, self.cut, grid) if self.clip_cache is None else None
+            if crop is None:
+                X = self._decode(file_path)
+            else:
+                X, start = crop
+            # normalizes along axis 0, which only depends on the samples inside the crop
             X = librosa.util.normalize(X)
         except:
             print(f"Error loading {file_path}")
-            return self.__getitem__(np.random.randint(len(self.file_list)))
+            return self.__getitem__(np.random.randint(len(self)))
         if X.shape[0] > 1:
             # if not mono, take random channel
             channel_id = np.random.randint(X.shape[0])
             X = X[channel_id]
+        else:
+            channel_id = 0
+        if crop is not None:
+            X_pad = X
+        elif self.codec_augment is not None:
+            X_pad, start = self.codec_augment.crop(X, self.cut)
+        else:
+            X_pad = pad_random(X, self.cut)
+        if self.codec_augment is not None:
+            X_pad = self.codec_augment(X_pad, (file_path, channel_id, start))
+        x_inp = Tensor(X_pad)
+        if self.raw_features:
+            return x_inp, y
+        # x_inp = self.lfcc(x_inp.unsqueeze(0))
+        x_inp = self.spec(x_inp.unsqueeze(0))#.squeeze(0).transpose(0, 1)
+
+        return x_inp, y
+
+
+class Dataset_SingFakeStore(Dataset):
+    def __init__(self, base_dir, is_mixture=False, target_sr=16000):
+        """
+        base_dir should contain mixtures.int16 / vocals.int16 and their .store.npz index, as written by
+        dataset/audio_store.py. Crops are sliced straight out of the int16 memmap, already resampled
+        and peak-normalized; only the 4 sec crop is converted to float.
+        """
+        self.base_dir = base_dir
+        self.is_mixture = is_mixture
+        self.target_sr = target_sr
+        self.cut = 64000  # take 4 sec audio (64000 samples)
+        folder = "mixtures" if self.is_mixture else "vocals"
+        self.audio_path = os.path.join(self.base_dir, folder + ".int16")
+        index_path = os.path.join(self.base_dir, folder + ".store.npz")
+
+        assert os.path.exists(index_path), f"{index_path} does not exist!"
+        with np.load(index_path) as data:
+            assert int(data["sample_rate"]) == self.target_sr, f"{index_path} is not stored at {self.target_sr} Hz"
+            self.offsets = data["offsets"]
+            self.lengths = data["lengths"]
+            self.channels = data["channels"]
+            self.labels = data["labels"]
+        # opened on first use, so every DataLoader worker maps the file itself
+        self.audio = None
+
+        # self.lfcc = LFCC(320, 160, 512, 16000, 20, with_energy=False)
+        self.spec = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=160, win_length=512, power=2, normalized=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if self.audio is None:
+            self.audio = np.memmap(self.audio_path, dtype=np.int16, mode="r")
+        length = int(self.lengths[index])
+        start = int(self.offsets[index])
+        # (channels, samples) view, channels are stored one after the other
+        X = self.audio[start:start + int(self.channels[index]) * length].reshape(-1, length)
+        X, _ = crop_channels(X, self.cut)
+        X = X.astype(np.float32) / 32767
+        if X.shape[0] > 1:
+            # same as librosa.util.normalize on the (channels, samples) clip in Dataset_SingFake, which
+            # normalizes along axis 0; mono clips are already peak-normalized in the store
+            X = librosa.util.normalize(X)
+            # if not mono, take random channel
+            channel_id = np.random.randint(X.shape[0])
+        else:
+            channel_id = 0
+        X_pad = X[channel_id]
+        x_inp = torch.from_numpy(X_pad)
+        # x_inp = self.lfcc(x_inp.unsqueeze(0))
+        x_inp = self.spec(x_inp.unsqueeze(0))#.squeeze(0).transpose(0, 1)
+
+        y = int(self.labels[index])
+        return x_inp, y
+
+
+class Dataset_SingFakeFeatures(Dataset):
+    def __init__(self, base_dir, is_mixture=False, target_sr=16000, cache_dir=None, feat_len=401):
+        """
+        Reads the full-clip features written by feature_cache.py and crops them in the frame domain,
+        like ASVspoof2019LA does with its .pt features: feat_len frames of a random channel, repeat-padded
+        when the clip is shorter (401 frames is what a 4 sec crop gives). The cache is looked up under
+        the hash of the BatchFeature parameters, so features of a different extractor are never read.
+        """
+        self.base_dir = base_dir
+        self.is_mixture = is_mixture
+        self.feat_len = feat_len
+        self.params = feature_params(BatchFeature(), target_sr)
+        self.feature_path, index_path = feature_cache_paths(base_dir, is_mixture, self.params, cache_dir)
+
+        assert os.path.exists(index_path), f"{index_path} does not exist, build it with feature_cache.py"
+        with np.load(index_path) as data:
+            self.offsets = data["offsets"]
+            self.frames = data["frames"]
+            self.channels = data["channels"]
+            self.labels = data["labels"]
+            self.dim = int(data["dim"])
+        # opened on first use, so every DataLoader worker maps the file itself
+        self.features = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if self.features is None:
+            self.features = np.memmap(self.feature_path, dtype=np.float16, mode="r").reshape(-1, self.dim)
+        frames = int(self.frames[index])
+        # rows of one channel, channels are stored one after the other
+        start = int(self.offsets[index]) + np.random.randint(int(self.channels[index])) * frames
+        if frames > self.feat_len:
+            start += np.random.randint(frames - self.feat_len + 1)
+            featureTensor = torch.from_numpy(self.features[start:start + self.feat_len].astype(np.float32))[None]
+        else:
+            featureTensor = torch.from_numpy(self.features[start:start + frames].astype(np.float32))[None]
+            featureTensor = repeat_padding_Tensor(featureTensor, self.feat_len)
+        if self.params["feature"] == "spec":
+            # stored frame by frame, Spectrogram gives (freq, frames)
+            featureTensor = featureTensor.transpose(1, 2)
+        return featureTensor, int(self.labels[index])
+
+
+class Dataset_SingFakeEval(Dataset):
+    def __init__(self, base_dir, is_mixture=False, windows=1, raw_features=False):
+        """
+        A dev/test split written by materialize_eval.py: `windows` fixed crops per clip, already turned
+        into features (or raw crops with raw_features, for BatchFeature), in one float32 memmap. Every
+        evaluation sees the same crops, so the EER is reproducible, and nothing is decoded.
+        """
+        kind = "audio" if raw_features else feature_key(feature_params(BatchFeature()))
+        self.tensor_path, index_path = materialized_paths(base_dir, is_mixture, kind, windows)
+        assert os.path.exists(index_path), f"{index_path} does not exist, build it with materialize_eval.py"
+        with np.load(index_path) as data:
+            self.shape = tuple(int(n) for n in data["shape"])
+            self.labels = data["labels"].astype(np.int64)
+            self.clips = data["clips"]
+        # opened on first use, so every DataLoader worker maps the file itself
+        self.data = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _open(self):
+        if self.data is None:
+            self.data = np.memmap(self.tensor_path, dtype=np.float32, mode="r", shape=(len(self.labels),) + self.shape)
+        return self.data
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self._open()[index])), int(self.labels[index])
+
+    def __getitems__(self, indices):
+        # a batch of consecutive indices (shuffle=False) is read as one slice
+        start = indices[0]
+        if list(indices) == list(range(start, start + len(indices))):
+            x = torch.from_numpy(np.array(self._open()[start:start + len(indices)]))
+            return list(zip(x, self.labels[start:start + len(indices)].tolist()))
+        return [self[index] for index in indices]
+
+
+class Dataset_SingFakeShards(IterableDataset):
+    def __init__(self, base_dir, is_mixture=False, target_sr=16000, shuffle_buffer=1000, seed=0):
+        """
+        base_dir should contain shards/, as written by dataset/split.py with output_mode = "shards".
+        Shards are read sequentially and split across DataLoader workers; samples are shuffled
+        through a buffer of shuffle_buffer samples. Call set_epoch() before every epoch to get a
+        new shard order.
+        """
+        self.base_dir = base_dir
+        self.is_mixture = is_mixture
+        self.target_sr = target_sr
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.cut = 64000  # take 4 sec audio (64000 samples)
+        self.shard_path = os.path.join(self.base_dir, "shards")
+        self.field = "mixture.flac" if self.is_mixture else "vocals.flac"
+
+        assert os.path.exists(self.shard_path), f"{self.shard_path} does not exist!"
+        with open(os.path.join(self.shard_path, "shards.json"), "r") as f:
+            self.index = json.load(f)
+        self.shards = sorted(self.index.keys())
+
+        # self.lfcc = LFCC(320, 160, 512, 16000, 20, with_energy=False)
+        self.spec = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=160, win_length=512, power=2, normalized=True)
+
+    def __len__(self):
+        return sum(self.index.values())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _process(self, sample):
+        X, sr = sf.read(io.BytesIO(sample[self.field]), dtype="float32", always_2d=True)
+        X = X.T
+        if sr != self.target_sr:
+            X = librosa.resample(X, orig_sr=sr, target_sr=self.target_sr)
+        X = librosa.util.normalize(X)
+        if X.shape[0] > 1:
+            # if not mono, take random channel
+            channel_id = np.random.randint(X.shape[0])
+        else:
+            channel_id = 0
+        X = X[channel_id]
         X_pad = pad_random(X, self.cut)
         x_inp = Tensor(X_pad)
         # x_inp = self.lfcc(x_inp.unsqueeze(0))
         x_inp = self.spec(x_inp.unsqueeze(0))#.squeeze(0).transpose(0, 1)
 
-        y = int(key.split("_")[0])
+        y = int(json.loads(sample["json"])["label"])
         return x_inp, y
 
+    def _samples(self):
+        # same shard order in every worker, then every worker takes its own share of the shards
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+        for shard in shards:
+            for sample in iterate_shard(os.path.join(self.shard_path, shard)):
+                try:
+                    yield self._process(sample)
+                except Exception:
+                    print(f"Error loading {sample['__key__']} from {shard}")
+
+    def __iter__(self):
+        buffer = []
+        for item in self._samples():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            idx = np.random.randint(len(buffer))
+            buffer[idx], item = item, buffer[idx]
+            yield item
+        np.random.shuffle(buffer)
+        yield from buffer
+
+
+def iterate_shard(path):
+    """
+    Reads a shard sequentially and yields one dict per sample: {"__key__": key, "vocals.flac": bytes, ...}.
+    A copy of dataset/shards.py:iterate_shard, which defines the shard layout; keep the two identical.
+    """
+    sample = None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, field = member.name.split(".", 1)
+            if sample is not None and sample["__key__"] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {"__key__": key}
+            sample[field] = tar.extractfile(member).read()
+    if sample is not None:
+        yield sample
+
+
+class SplitManifest:
+    """
+    Columnar view of base_dir/index.npz (written by dataset/audit.py), restricted to the usable files
+    of mixtures/ or vocals/. Paths are kept as one byte blob plus offsets, and labels, song ids and
+    durations as NumPy arrays, so DataLoader workers do not copy millions of Python strings after fork.
+    labels/songs select by label and song id, min_duration/max_duration by seconds.
+    """
+    def __init__(self, base_dir, is_mixture=False, labels=None, songs=None, min_duration=None, max_duration=None):
+        self.base_dir = base_dir
+        with np.load(os.path.join(base_dir, "index.npz"), allow_pickle=False) as data:
+            self.blob = data["paths"]
+            offsets = data["offsets"]
+            files = data["files"]
+            self.song_names = data["songs"]
+        # folder 0 is vocals/, 1 is mixtures/
+        keep = (files["folder"] == (1 if is_mixture else 0)) & files["ok"]
+        if labels is not None:
+            keep &= np.isin(files["label"], labels)
+        if songs is not None:
+            keep &= np.isin(self.song_names[files["song"]], np.asarray(songs, dtype=np.str_))
+        if min_duration is not None:
+            keep &= files["duration"] >= min_duration
+        if max_duration is not None:
+            keep &= files["duration"] <= max_duration
+        self.starts = offsets[:-1][keep]
+        self.ends = offsets[1:][keep]
+        self.labels = files["label"][keep]
+        self.songs = files["song"][keep]
+        self.durations = files["duration"][keep]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def path(self, index):
+        return os.path.join(self.base_dir, self.blob[self.starts[index]:self.ends[index]].tobytes().decode("utf-8"))
+
+
+def load_random_crop(file_path, target_sr, max_len, grid=1, padding=0.1):
+    """
+    Picks a random max_len crop (counted at target_sr) from the frame count alone, then decodes and
+    resamples only that window, plus `padding` seconds on each side as context for the resampler.
+    Returns (crop, start) shaped like librosa.load(mono=False) output, or None when the clip is not
+    longer than max_len, in which case the caller decodes it whole and repeat-pads it.
+    grid snaps the start to a multiple of grid samples (see CodecAugment).
+    """
+    target_sr = int(target_sr)
+    with sf.SoundFile(file_path) as f:
+        sr = f.samplerate
+        # length after resampling, as librosa.load computes it
+        x_len = -(-f.frames * target_sr // sr)
+        if x_len <= max_len:
+            return None
+        stt = np.random.randint(max(1, (x_len - max_len) // grid)) * grid
+        if sr == target_sr:
+            f.seek(stt)
+            X = f.read(max_len, dtype="float32", always_2d=True).T
+        else:
+            # the read starts on a multiple of sr / gcd(sr, target_sr) samples, which falls exactly
+            # on a sample of the resampled signal
+            step = sr // math.gcd(sr, target_sr)
+            pad = int(round(padding * sr))
+            read_start = max(0, stt * sr // target_sr - pad) // step * step
+            read_end = min(f.frames, -(-(stt + max_len) * sr // target_sr) + pad)
+            f.seek(read_start)
+            X = f.read(read_end - read_start, dtype="float32", always_2d=True).T
+            X = librosa.resample(X, orig_sr=sr, target_sr=target_sr)
+            offset = read_start * target_sr // sr
+            X = X[:, stt - offset:stt - offset + max_len]
+    if X.shape[1] < max_len:
+        X = np.pad(X, ((0, 0), (0, max_len - X.shape[1])))
+    return (X[0] if X.shape[0] == 1 else X), stt
+
 
 def pad_random(x: np.ndarray, max_len: int = 64600):
     x_len = x.shape[0]
@@ -185,9 +600,120 @@ def pad_random(x: np.ndarray, max_len: int = 64600):
     return padded_x
 
 
+def crop_channels(x: np.ndarray, max_len: int, grid: int = 1):
+    """
+    pad_random for a (channels, samples) array: every channel gets the same crop, starting on a
+    multiple of grid samples. Returns (crop, start).
+    """
+    x_len = x.shape[1]
+    if x_len > max_len:
+        stt = np.random.randint(max(1, (x_len - max_len) // grid)) * grid
+        return x[:, stt:stt + max_len], stt
+
+    num_repeats = int(max_len / x_len) + 1
+    return np.tile(x, (1, num_repeats))[:, :max_len], 0
+
+
+class MultiCropBatchSampler(Sampler):
+    """
+    Batches of clip indices for a Dataset_SingFake that emits examples_per_clip examples per clip, sized
+    so that a batch holds batch_size examples once flatten_collate has flattened it.
+    """
+    def __init__(self, num_clips, batch_size, examples_per_clip, shuffle=True, drop_last=False, generator=None):
+        self.num_clips = num_clips
+        self.clips_per_batch = max(1, batch_size // examples_per_clip)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(self.num_clips, generator=self.generator).tolist()
+        else:
+            order = list(range(self.num_clips))
+        for i in range(0, self.num_clips, self.clips_per_batch):
+            batch = order[i:i + self.clips_per_batch]
+            if self.drop_last and len(batch) < self.clips_per_batch:
+                return
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_clips // self.clips_per_batch
+        return -(-self.num_clips // self.clips_per_batch)
+
+
+def flatten_collate(samples):
+    """
+    Collates the (examples, labels) pairs of a multi-crop Dataset_SingFake into one flat batch.
+    """
+    xs, ys = zip(*samples)
+    return torch.cat(xs), torch.cat(ys)
+
+
+class BatchFeature(torch.nn.Module):
+    """
+    The feature Dataset_SingFake computes per item, for a whole batch of raw crops at once:
+    (batch, samples) -> (batch, 1, ...), the same shape the loader returns with features. Meant to run
+    on the training device, between a raw_features=True loader and the model.
+    """
+    def __init__(self):
+        super().__init__()
+        # self.lfcc = LFCC(320, 160, 512, 16000, 20, with_energy=False)
+        self.spec = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=160, win_length=512, power=2, normalized=True)
+
+    def forward(self, x):
+        # return self.lfcc(x).unsqueeze(1)
+        return self.spec(x).unsqueeze(1)
+
+
+FEATURE_CACHE_VERSION = 1
+
+
+def feature_params(extractor, target_sr=16000):
+    """
+    Everything the cached features of a BatchFeature depend on; feature_key hashes it.
+    """
+    module = extractor.lfcc if hasattr(extractor, "lfcc") else extractor.spec
+    if isinstance(module, LFCC):
+        params = {"feature": "lfcc", "fl": module.fl, "fs": module.fs, "fn": module.fn, "sr": module.sr,
+                  "filter_num": module.filter_num, "with_energy": module.with_energy,
+                  "with_emphasis": module.with_emphasis, "with_delta": module.with_delta}
+    else:
+        params = {"feature": "spec", "n_fft": module.n_fft, "hop": module.hop_length,
+                  "win_length": module.win_length, "power": module.power, "normalized": module.normalized}
+    params["target_sr"] = target_sr
+    params["version"] = FEATURE_CACHE_VERSION
+    return params
+
+
+def feature_key(params):
+    return hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def feature_cache_paths(base_dir, is_mixture, params, cache_dir=None):
+    """
+    (features, index) paths of one split and folder: <cache_dir>/<feature_key>/<folder>.f16 and .npz,
+    with cache_dir defaulting to base_dir/features.
+    """
+    folder = "mixtures" if is_mixture else "vocals"
+    key_dir = os.path.join(cache_dir or os.path.join(base_dir, "features"), feature_key(params))
+    return os.path.join(key_dir, folder + ".f16"), os.path.join(key_dir, folder + ".npz")
+
+
+def materialized_paths(base_dir, is_mixture, kind, windows=1):
+    """
+    (tensor, index) paths of a split written by materialize_eval.py:
+    <base_dir>/materialized/<folder>_<kind>_w<windows>.f32 and .npz
+    """
+    name = "%s_%s_w%d" % ("mixtures" if is_mixture else "vocals", kind, windows)
+    return (os.path.join(base_dir, "materialized", name + ".f32"),
+            os.path.join(base_dir, "materialized", name + ".npz"))
+
+
 class VCC2020(Dataset):
     def __init__(self, path_to_features="/data2/neil/VCC2020/", feature='LFCC',
-                 feat_len=750, genuine_only=False):
+                 feat_len=750, genuine_only=False, use_store=False):
         super(VCC2020, self).__init__()
         self.ptf = path_to_features
         self.feat_len = feat_len
@@ -198,7 +724,11 @@ class VCC2020(Dataset):
                     "T30": 50, "T31": 51, "T32": 52, "T33": 53, "TAR": 54}
         self.label = {"spoof": 1, "bonafide": 0}
         self.genuine_only = genuine_only
-        self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
+        self.store = FeatureStore(os.path.join(self.ptf, self.feature)) if use_store else None
+        if self.store is not None:
+            self.all_files = self.store.files()
+        else:
+            self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
 
     def __len__(self):
         if self.genuine_only:
@@ -209,7 +739,7 @@ class VCC2020(Dataset):
         filepath = self.all_files[idx]
         basename = os.path.basename(filepath)
         all_info = basename.split(".")[0].split("_")
-        featureTensor = torch.load(filepath)
+        featureTensor = torch.load(filepath) if self.store is None else self.store.load(filepath, self.feat_len)
         this_feat_len = featureTensor.shape[1]
         if this_feat_len > self.feat_len:
             startp = np.random.randint(this_feat_len - self.feat_len)
@@ -225,7 +755,7 @@ class VCC2020(Dataset):
 
 
 class ASVspoof2015(Dataset):
-    def __init__(self, path_to_features, part='train', feature='LFCC', feat_len=750):
+    def __init__(self, path_to_features, part='train', feature='LFCC', feat_len=750, use_store=False):
         super(ASVspoof2015, self).__init__()
         self.path_to_features = path_to_features
         self.part = part
@@ -235,7 +765,11 @@ class ASVspoof2015(Dataset):
         self.tag = {"human": 0, "S1": 1, "S2": 2, "S3": 3, "S4": 4, "S5": 5,
                     "S6": 6, "S7": 7, "S8": 8, "S9": 9, "S10": 10}
         self.label = {"spoof": 1, "human": 0}
-        self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
+        self.store = FeatureStore(os.path.join(self.ptf, self.feature)) if use_store else None
+        if self.store is not None:
+            self.all_files = self.store.files()
+        else:
+            self.all_files = librosa.util.find_files(os.path.join(self.ptf, self.feature), ext="pt")
 
     def __len__(self):
         return len(self.all_files)
@@ -244,7 +778,7 @@ class ASVspoof2015(Dataset):
         filepath = self.all_files[idx]
         basename = os.path.basename(filepath)
         all_info = basename.split(".")[0].split("_")
-        featureTensor = torch.load(filepath)
+        featureTensor = torch.load(filepath) if self.store is None else self.store.load(filepath, self.feat_len)
         this_feat_len = featureTensor.shape[1]
         if this_feat_len > self.feat_len:
             startp = np.random.randint(this_feat_len - self.feat_len)
@@ -260,6 +794,60 @@ class ASVspoof2015(Dataset):
         return default_collate(samples)
 
 
+def feature_store_paths(feature_dir):
+    """
+    (data, index) paths of the FeatureStore of a folder of .pt features: <folder>.store and <folder>.store.npz
+    """
+    feature_dir = feature_dir.rstrip("/")
+    return feature_dir + ".store", feature_dir + ".store.npz"
+
+
+class FeatureStore:
+    """
+    All .pt features of one folder (as written by preprocess.py, one (1, frames, ...) tensor per
+    utterance) in one flat memmap, written by consolidate_features.py: row r holds frame r, utterance i
+    is rows offsets[i]:offsets[i] + lengths[i]. The index also keeps the file names and their tag and
+    label fields; names are relative to the folder. Reading a crop is one slice instead of a torch.load (pickle + zip) of the whole file.
+    """
+    def __init__(self, feature_dir):
+        self.feature_dir = feature_dir
+        self.data_path, index_path = feature_store_paths(feature_dir)
+        assert os.path.exists(index_path), f"{index_path} does not exist, build it with consolidate_features.py"
+        with np.load(index_path) as data:
+            self.offsets = data["offsets"]
+            self.lengths = data["lengths"]
+            self.row_shape = tuple(int(n) for n in data["row_shape"])
+            self.dtype = np.dtype(str(data["dtype"]))
+            blob, name_offsets = data["names"].tobytes(), data["name_offsets"]
+            self.tags = data["tags"]
+            self.labels = data["labels"]
+        self.names = [blob[name_offsets[i]:name_offsets[i + 1]].decode("utf-8") for i in range(len(self.offsets))]
+        self.positions = {path: i for i, path in enumerate(self.files())}
+        # opened on first use, so every DataLoader worker maps the file itself
+        self.data = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def files(self):
+        # the paths librosa.util.find_files returns for the folder, in the same order
+        return [os.path.join(self.feature_dir, name) for name in self.names]
+
+    def load(self, path, feat_len=None):
+        """
+        The (1, frames, ...) float32 tensor of a file (a path from files()); with feat_len, only a random feat_len window of
+        longer files is read, picked like the .pt datasets do.
+        """
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=self.dtype, mode="r").reshape((-1,) + self.row_shape)
+        index = self.positions[path]
+        start, length = int(self.offsets[index]), int(self.lengths[index])
+        if feat_len is not None and length > feat_len:
+            start += np.random.randint(length - feat_len)
+            length = feat_len
+        return torch.from_numpy(self.data[start:start + length].astype(np.float32))[None]
+
+
 def repeat_padding_Tensor(spec, ref_len):
     mul = int(np.ceil(ref_len / spec.shape[1]))
     spec = spec.repeat(1, mul, 1)[:, :ref_len, :]
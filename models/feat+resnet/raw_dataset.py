@@ -1,6 +1,5 @@
 #!/usr/bin/python3
 
-import numpy as np
 import torch
 from torch import Tensor
 from torch.utils.data import Dataset
@@ -8,14 +7,15 @@ import scipy.io as sio
 import pickle
 import os
 import librosa
+from audio_io import load_audio
 from torch.utils.data.dataloader import default_collate
 import warnings
 
 
 def torchaudio_load(filepath):
-    wave, sr = librosa.load(filepath, sr=16000)
-    wave = librosa.util.normalize(wave)
-    waveform = torch.Tensor(np.expand_dims(wave, axis=0))
+    # librosa.load(filepath, sr=16000) + librosa.util.normalize, without a float64 read or a copy
+    wave, sr = load_audio(filepath, 16000, normalize=True)
+    waveform = torch.from_numpy(wave).unsqueeze(0)
     return [waveform, sr]
 
 class ASVspoof2019Raw(Dataset):
@@ -0,0 +1,57 @@
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from dataset import Dataset_SingFake, BatchFeature
+
+# Training-side throughput of the two feature paths, features on the device included:
+#   per item   the loader workers compute the feature of every crop (the default)
+#   per batch  the workers return raw crops, BatchFeature computes the batch on the device
+#              (train_SVspoof.py / test.py --batch_features)
+
+
+def benchmark(loader, batch_feature, device, num_batches):
+    """
+    Returns samples/sec over the batches after the first, or None if the loader has no such batches.
+    """
+    samples = 0
+    start = None
+    for i, (feat, _) in enumerate(loader):
+        feat = feat.to(device)
+        if batch_feature is not None:
+            feat = batch_feature(feat)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if i == 0:
+            # the first batch includes starting the workers
+            start = time.perf_counter()
+            continue
+        samples += feat.shape[0]
+        if i == num_batches:
+            break
+    if samples == 0:
+        return None
+    return samples / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Samples/sec of per-item and per-batch feature extraction.")
+    parser.add_argument("-d", "--path_to_database", type=str, required=True, help="split folder, e.g. <dataset>/train")
+    parser.add_argument('--is_mixture', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--num_batches', type=int, default=20, help="batches timed per path, after one warm-up batch")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    with torch.no_grad():
+        for name, raw in [("per item", False), ("per batch", True)]:
+            dataset = Dataset_SingFake(args.path_to_database, args.is_mixture, raw_features=raw)
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+            batch_feature = BatchFeature().to(device) if raw else None
+            rate = benchmark(loader, batch_feature, device, args.num_batches)
+            if rate is None:
+                print("%s: nothing to time, the split needs more than one batch of %d clips" % (name, args.batch_size))
+            else:
+                print("%s: %.1f samples/sec" % (name, rate))
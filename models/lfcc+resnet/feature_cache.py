@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+import librosa
+from concurrent.futures import ProcessPoolExecutor
+from dataset import Dataset_SingFake, BatchFeature, feature_params, feature_cache_paths
+
+# Computes the full-clip features of a split once, for Dataset_SingFakeFeatures
+# (train_SVspoof.py --use_feature_cache). Per split and folder (vocals or mixtures):
+#   <cache_dir>/<key>/params.json   the BatchFeature parameters hashed into <key>
+#   <cache_dir>/<key>/<folder>.f16  float16 rows of `dim` values, one row per frame; every clip is
+#                                   stored channel by channel
+#   <cache_dir>/<key>/<folder>.npz  offsets (rows) int64, frames int32, channels int16, labels int8,
+#                                   dim, and paths/path_offsets (utf-8 blob, relative to the split)
+# cache_dir defaults to <split>/features. Changing the extractor in BatchFeature changes <key>, so a
+# new cache is built next to the old one. Builds are incremental: clips already in the index are
+# skipped, new ones appended, and the index is saved every checkpoint_every clips, so an interrupted
+# build resumes where it stopped.
+
+_extractor = None
+
+
+def compute_features(path, target_sr=16000):
+    """
+    Returns (float16 rows, frames, channels) for one clip, or None if it cannot be decoded.
+    """
+    global _extractor
+    if _extractor is None:
+        # one thread per worker process
+        torch.set_num_threads(1)
+        _extractor = BatchFeature()
+    try:
+        X, _ = librosa.load(path, sr=target_sr, mono=False)
+    except Exception as e:
+        print(f"Error loading {path}: {e}")
+        return None
+    # same normalization as Dataset_SingFake; it works per sample, so it does not depend on the crop
+    X = librosa.util.normalize(X)
+    if X.ndim == 1:
+        X = X[None]
+    with torch.no_grad():
+        # channels as the batch: (channels, 1, ...)
+        feat = _extractor(torch.from_numpy(np.ascontiguousarray(X)))[:, 0]
+    if hasattr(_extractor, "spec"):
+        # Spectrogram gives (freq, frames)
+        feat = feat.transpose(1, 2)
+    feat = feat.numpy()
+    return feat.reshape(-1, feat.shape[-1]).astype(np.float16), feat.shape[1], feat.shape[0]
+
+
+def _compute_task(task):
+    return compute_features(*task)
+
+
+def load_cache_index(index_path):
+    if not os.path.exists(index_path):
+        return {"paths": [], "offsets": [], "frames": [], "channels": [], "labels": [], "dim": 0}
+    with np.load(index_path) as data:
+        blob, path_offsets = data["paths"].tobytes(), data["path_offsets"]
+        return {
+            "paths": [blob[path_offsets[i]:path_offsets[i + 1]].decode("utf-8") for i in range(len(path_offsets) - 1)],
+            "offsets": list(data["offsets"]),
+            "frames": list(data["frames"]),
+            "channels": list(data["channels"]),
+            "labels": list(data["labels"]),
+            "dim": int(data["dim"]),
+        }
+
+
+def save_cache_index(index_path, index):
+    encoded = [path.encode("utf-8") for path in index["paths"]]
+    path_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in encoded], out=path_offsets[1:])
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, offsets=np.asarray(index["offsets"], dtype=np.int64),
+                 frames=np.asarray(index["frames"], dtype=np.int32),
+                 channels=np.asarray(index["channels"], dtype=np.int16),
+                 labels=np.asarray(index["labels"], dtype=np.int8), dim=np.int32(index["dim"]),
+                 paths=np.frombuffer(b"".join(encoded), dtype=np.uint8), path_offsets=path_offsets)
+    os.replace(tmp_path, index_path)
+
+
+def build_cache(base_dir, is_mixture=False, cache_dir=None, target_sr=16000, max_workers=None, checkpoint_every=500):
+    params = feature_params(BatchFeature(), target_sr)
+    feature_path, index_path = feature_cache_paths(base_dir, is_mixture, params, cache_dir)
+    os.makedirs(os.path.dirname(feature_path), exist_ok=True)
+    with open(os.path.join(os.path.dirname(feature_path), "params.json"), "w") as f:
+        json.dump(params, f, indent=4)
+
+    # same clip list as the flac training set, from the audit manifest when there is one
+    dataset = Dataset_SingFake(base_dir, is_mixture)
+    clips = [dataset._file(i) for i in range(len(dataset))]
+    index = load_cache_index(index_path)
+    done = set(index["paths"])
+    todo = [(path, label) for path, label in clips if os.path.relpath(path, base_dir) not in done]
+
+    rows = 0
+    if len(index["paths"]) > 0:
+        rows = int(index["offsets"][-1]) + int(index["frames"][-1]) * int(index["channels"][-1])
+    added = 0
+    with open(feature_path, "ab") as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # rows appended after the last saved index belong to no clip
+        f.truncate(rows * index["dim"] * 2)
+        results = executor.map(_compute_task, [(path, target_sr) for path, _ in todo], chunksize=8)
+        for (path, label), result in zip(todo, results):
+            if result is None or result[1] == 0:
+                continue
+            feat, frames, channels = result
+            index["dim"] = feat.shape[1]
+            f.write(feat.tobytes())
+            index["paths"].append(os.path.relpath(path, base_dir))
+            index["offsets"].append(rows)
+            index["frames"].append(frames)
+            index["channels"].append(channels)
+            index["labels"].append(label)
+            rows += len(feat)
+            added += 1
+            if added % checkpoint_every == 0:
+                f.flush()
+                save_cache_index(index_path, index)
+        f.flush()
+        save_cache_index(index_path, index)
+    return added, len(index["paths"]), rows * index["dim"] * 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache the full-clip features of a split as float16.")
+    parser.add_argument("base_dir", type=str, help="split folder with mixtures/ and vocals/, e.g. <dataset>/train")
+    parser.add_argument('--is_mixture', action='store_true')
+    parser.add_argument('--cache_dir', type=str, default=None, help="<base_dir>/features by default")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--checkpoint_every', type=int, default=500, help="clips between index saves")
+    args = parser.parse_args()
+
+    added, total, size = build_cache(args.base_dir, args.is_mixture, args.cache_dir, max_workers=args.workers,
+                                     checkpoint_every=args.checkpoint_every)
+    print("%d clips added, %d cached, %.2f GB" % (added, total, size / (1 << 30)))
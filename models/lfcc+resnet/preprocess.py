@@ -1,54 +1,224 @@
 import raw_dataset as dataset
-from audio_feature_extraction import LFCC
+from audio_feature_extraction import LFCC, delta
+from dataset import FeatureStore, feature_store_paths
+from consolidate_features import save_store_index
 import os
+import argparse
 import torch
+from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 from torchaudio import transforms
-from scipy.fftpack import fft, ifft, fftshift, ifftshift, next_fast_len
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import copy
+import soundfile as sf
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
 cuda = torch.cuda.is_available()
 print('Cuda device available: ', cuda)
-device = torch.device("cuda" if cuda else "cpu")
-
-
-# ## LFCC
-# for part_ in ["train", "dev", "eval"]:
-#     asvspoof_raw = dataset.ASVspoof2019Raw("LA", "/data1/neil/DS_10283_3336/", "/data1/neil/DS_10283_3336/LA/ASVspoof2019_LA_cm_protocols/", part=part_)
-#     target_dir = os.path.join("/data2/neil/ASVspoof2019LA", part_, "LFCC")
-#     if not os.path.exists(target_dir):
-#         os.makedirs(target_dir)
-#     lfcc = LFCC(320, 160, 512, 16000, 20, with_energy=False)
-#     lfcc = lfcc.to(device)
-#     for idx in tqdm(range(len(asvspoof_raw))):
-#         # if idx > 0: break # debug purpose
-#         waveform, filename, tag, label = asvspoof_raw[idx]
-#         # waveform = spectral_whitening(waveform.squeeze(0).numpy())
-#         # waveform = torch.from_numpy(np.expand_dims(waveform, axis=0))
-#         waveform = waveform.to(device)
-#         lfccOfWav = lfcc(waveform)
-#         # print(lfccOfWav.shape)
-#         torch.save(lfccOfWav, os.path.join(target_dir, "%05d_%s_%s_%s.pt" % (idx, filename, tag, label)))
-#     print("Done!")
-
-## MFCC
-for part_ in ["train", "dev", "eval"]:
-    asvspoof_raw = dataset.ASVspoof2019Raw("LA", "/data1/neil/DS_10283_3336/", "/data1/neil/DS_10283_3336/LA/ASVspoof2019_LA_cm_protocols/", part=part_)
-    target_dir = os.path.join("/data2/neil/ASVspoof2019LA", part_, "MFCC")
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-    transform = transforms.MFCC(sample_rate=16000, n_mfcc=60, melkwargs={"n_fft": 320, "hop_length": 160, "center": False})
-    transform = transform.to(device)
-    for idx in tqdm(range(len(asvspoof_raw))):
-        # if idx > 0: break
-        waveform, filename, tag, label = asvspoof_raw[idx]
-        # waveform = spectral_whitening(waveform.squeeze(0).numpy())
-        # waveform = torch.from_numpy(np.expand_dims(waveform, axis=0))
-        waveform = waveform.to(device)
-        mfccOfWav = transform(waveform).transpose(2, 1)
-        # print(mfccOfWav.shape)
-        torch.save(mfccOfWav, os.path.join(target_dir, "%05d_%s_%s_%s.pt" % (idx, filename, tag, label)))
+
+# Extracts LFCC or MFCC features of the ASVspoof2019 LA utterances. DataLoader workers decode the
+# utterances, which are grouped by length so batches need little padding, and the feature module runs
+# on whole batches. Every utterance gets the frames it would get on its own: LFCC padding is made to be
+# zero after pre-emphasis and the deltas are computed per utterance, MFCC frames (center=False) never
+# reach into the padding and the top_db floor is taken per utterance. On CPU the workers also compute
+# the features, one thread each, so the job scales with the number of cores; on GPU they decode and
+# pad, and the features are computed on the device.
+# The output is sharded: <out>/<part>/<feature>.shards/shard_%05d.store(.npz), in the FeatureStore
+# format. Each shard is a fixed slice of the length-sorted utterances, so a re-run skips finished shards.
+# When all shards are done they are merged into <out>/<part>/<feature>.store(.npz), which the datasets
+# read with use_store=True. With --pt, every utterance is written as
+# <out>/<part>/<feature>/%05d_<file>_<tag>_<label>.pt instead, as before, and existing files are skipped.
+
+FEATURES = ["LFCC", "MFCC"]
+
+
+def make_module(feature):
+    if feature == "LFCC":
+        # the deltas are added per utterance, once the padding frames are cut off
+        return LFCC(320, 160, 512, 16000, 20, with_energy=False, with_delta=False)
+    return transforms.MFCC(sample_rate=16000, n_mfcc=60, melkwargs={"n_fft": 320, "hop_length": 160, "center": False})
+
+
+def num_frames(feature, n):
+    return n // 160 + 1 if feature == "LFCC" else (n - 320) // 160 + 1
+
+
+def pad_batch(feature, waveforms):
+    lengths = [len(waveform) for waveform in waveforms]
+    x = torch.zeros(len(waveforms), max(lengths))
+    for i, waveform in enumerate(waveforms):
+        x[i, :lengths[i]] = waveform
+        if feature == "LFCC" and lengths[i] < x.shape[1]:
+            # x[n] = 0.97 * x[n - 1] is zero after LFCC's pre-emphasis, like the zeros torch.stft pads a
+            # lone utterance with
+            x[i, lengths[i]:] = waveform[-1] * 0.97 ** torch.arange(1, x.shape[1] - lengths[i] + 1)
+    return x, lengths
+
+
+def batch_features(module, feature, x, lengths):
+    """
+    Features of a padded batch, as a list of the (1, frames, dim) tensors preprocess.py saves.
+    """
+    with torch.no_grad():
+        if feature == "MFCC":
+            # (batch, 1, samples): amplitude_to_DB takes its top_db floor per item, not over the batch
+            out = module(x.unsqueeze(1)).squeeze(1).transpose(2, 1).cpu()
+        else:
+            out = module(x).cpu()
+    feats = []
+    for j, n in enumerate(lengths):
+        feat = out[j:j + 1, :num_frames(feature, n)]
+        if feature == "LFCC":
+            feat_delta = delta(feat)
+            feat = torch.cat((feat, feat_delta, delta(feat_delta)), 2)
+        feats.append(feat)
+    return feats
+
+
+class IndexedRaw(Dataset):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, idx):
+        return (idx,) + tuple(self.raw[idx])
+
+
+class BatchCollate:
+    """
+    Pads a batch of utterances to the longest one; with compute, also runs the feature module on it
+    (in the DataLoader worker).
+    """
+    def __init__(self, feature, compute):
+        self.feature = feature
+        self.compute = compute
+        self.module = None
+
+    def __call__(self, samples):
+        x, lengths = pad_batch(self.feature, [waveform[0] for _, waveform, _, _, _ in samples])
+        if self.compute:
+            if self.module is None:
+                torch.set_num_threads(1)
+                self.module = make_module(self.feature)
+            x = batch_features(self.module, self.feature, x, lengths)
+        return x, lengths, [idx for idx, _, _, _, _ in samples]
+
+
+def utterance_lengths(raw, workers):
+    # from the flac headers, for the bucketing only
+    def length(info):
+        header = sf.info(os.path.join(raw.path_to_audio, info[1] + ".flac"))
+        return int(np.ceil(header.frames * 16000 / header.samplerate))
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        return list(executor.map(length, raw.all_info))
+
+
+def merge_shards(shard_paths, target_dir):
+    """
+    Merges finished shards into the FeatureStore of target_dir, in file name order (the order
+    librosa.util.find_files gives the .pt files).
+    """
+    stores = [FeatureStore(path) for path in shard_paths]
+    entries = sorted((name, k, i) for k, store in enumerate(stores) for i, name in enumerate(store.names))
+    data = [np.memmap(store.data_path, dtype=store.dtype, mode="r").reshape((-1,) + store.row_shape)
+            for store in stores]
+    data_path, index_path = feature_store_paths(target_dir)
+    offsets, lengths, names, tags, labels = [], [], [], [], []
+    rows = 0
+    with open(data_path + ".tmp", "wb") as f:
+        for name, k, i in entries:
+            start, length = int(stores[k].offsets[i]), int(stores[k].lengths[i])
+            f.write(data[k][start:start + length].tobytes())
+            offsets.append(rows)
+            lengths.append(length)
+            rows += length
+            names.append(name)
+            tags.append(stores[k].tags[i])
+            labels.append(stores[k].labels[i])
+    os.replace(data_path + ".tmp", data_path)
+    save_store_index(index_path, offsets, lengths, stores[0].row_shape, stores[0].dtype, names, tags, labels)
+    return len(names)
+
+
+def preprocess(part, args):
+    raw = dataset.ASVspoof2019Raw("LA", args.path_to_database, args.path_to_protocol, part=part)
+    target_dir = os.path.join(args.out, part, args.feature)
+    names = ["%05d_%s_%s_%s.pt" % (idx, info[1], info[3], info[4]) for idx, info in enumerate(raw.all_info)]
+    lengths = utterance_lengths(raw, args.workers)
+    order = sorted(range(len(raw)), key=lambda idx: (lengths[idx], idx))
+
+    if args.pt:
+        os.makedirs(target_dir, exist_ok=True)
+        shards = [[idx for idx in order if not os.path.exists(os.path.join(target_dir, names[idx]))]]
+        shard_paths = [None]
+        todo = [0]
+    else:
+        os.makedirs(target_dir + ".shards", exist_ok=True)
+        shards = [order[start:start + args.shard_size] for start in range(0, len(order), args.shard_size)]
+        shard_paths = [os.path.join(target_dir + ".shards", "shard_%05d" % k) for k in range(len(shards))]
+        todo = [k for k in range(len(shards)) if not os.path.exists(feature_store_paths(shard_paths[k])[1])]
+    print("%s: %d utterances, %d to extract" % (part, len(raw), sum(len(shards[k]) for k in todo)))
+
+    batches = [(k, shards[k][start:start + args.batch_size]) for k in todo
+               for start in range(0, len(shards[k]), args.batch_size)]
+    device = torch.device(args.device)
+    in_workers = device.type == "cpu" and args.workers > 0
+    loader = DataLoader(IndexedRaw(raw), batch_sampler=[batch for _, batch in batches], num_workers=args.workers,
+                        collate_fn=BatchCollate(args.feature, in_workers))
+    module = None if in_workers else make_module(args.feature).to(device)
+    dtype = np.float16 if args.float16 else np.float32
+
+    shard, f = None, None
+    for b, (x, lengths, indices) in enumerate(tqdm(loader, total=len(batches))):
+        if module is not None:
+            x = batch_features(module, args.feature, x.to(device), lengths)
+        if not args.pt and batches[b][0] != shard:
+            shard = batches[b][0]
+            f = open(feature_store_paths(shard_paths[shard])[0] + ".tmp", "wb")
+            offsets, counts, shard_names, tags, labels, rows = [], [], [], [], [], 0
+        for feat, idx in zip(x, indices):
+            if args.pt:
+                torch.save(feat.clone(), os.path.join(target_dir, names[idx]))
+                continue
+            feat = feat[0]
+            f.write(feat.numpy().astype(dtype).tobytes())
+            offsets.append(rows)
+            counts.append(len(feat))
+            rows += len(feat)
+            shard_names.append(names[idx])
+            tags.append(raw.all_info[idx][3])
+            labels.append(raw.all_info[idx][4])
+        if not args.pt and (b + 1 == len(batches) or batches[b + 1][0] != shard):
+            # last batch of the shard: publish its data, then the index that marks it done
+            f.close()
+            data_path, index_path = feature_store_paths(shard_paths[shard])
+            os.replace(data_path + ".tmp", data_path)
+            save_store_index(index_path, offsets, counts, feat.shape[1:], dtype, shard_names, tags, labels)
+
+    if not args.pt:
+        print("%s: merged %d utterances into %s" % (part, merge_shards(shard_paths, target_dir),
+                                                   feature_store_paths(target_dir)[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract LFCC/MFCC features of ASVspoof2019 LA.")
+    parser.add_argument("--feature", type=str, default="MFCC", choices=FEATURES)
+    parser.add_argument("--parts", type=str, nargs="+", default=["train", "dev", "eval"])
+    parser.add_argument("-d", "--path_to_database", type=str, default="/data1/neil/DS_10283_3336/")
+    parser.add_argument("-p", "--path_to_protocol", type=str,
+                        default="/data1/neil/DS_10283_3336/LA/ASVspoof2019_LA_cm_protocols/")
+    parser.add_argument("-o", "--out", type=str, default="/data2/neil/ASVspoof2019LA")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="decoding (and, on CPU, feature) workers")
+    parser.add_argument("--batch_size", type=int, default=32, help="utterances per batch")
+    parser.add_argument("--shard_size", type=int, default=2048, help="utterances per shard")
+    parser.add_argument("--device", type=str, default="cuda" if cuda else "cpu")
+    parser.add_argument("--float16", action="store_true", help="store float16 instead of float32")
+    parser.add_argument("--pt", action="store_true", help="write one .pt file per utterance instead of shards")
+    args = parser.parse_args()
+
+    for part_ in args.parts:
+        preprocess(part_, args)
     print("Done!")
@@ -38,6 +38,13 @@ def init():
     parser.add_argument('--batch_size', type=int, default=64, help="Mini batch size for training")
     parser.add_argument('--is_mixture', type=str2bool, nargs='?', const=True, default=False,
                         help="whether use mixture or vocals in training")
+    parser.add_argument('--batch_features', action='store_true',
+                        help="singfake: load raw crops and compute the features per batch on the device")
+    parser.add_argument('--materialized_eval', action='store_true',
+                        help="singfake: test on the fixed crops written by materialize_eval.py")
+    parser.add_argument('--eval_windows', type=int, default=1, help="crops per clip of the materialized sets")
+    parser.add_argument('--use_feature_store', action='store_true',
+                        help="VCC2020/ASVspoof2015: read the .pt features from consolidate_features.py's store")
     parser.add_argument("--gpu", type=str, help="GPU index", default="0")
     args = parser.parse_args()
 
@@ -115,12 +122,18 @@ def test_model_on_ASVspoof2019LA(feat_model_path, loss_model_path, part, add_los
 def test_model_on_singfake(feat_model_path, loss_model_path, dataset_path, add_loss, args):
     model = torch.load(feat_model_path)
     loss_model = torch.load(loss_model_path) if add_loss is not None else None
-    test_set = Dataset_SingFake(dataset_path, is_mixture=args.is_mixture)
+    if args.materialized_eval:
+        test_set = Dataset_SingFakeEval(dataset_path, args.is_mixture, args.eval_windows, raw_features=args.batch_features)
+    else:
+        test_set = Dataset_SingFake(dataset_path, is_mixture=args.is_mixture, raw_features=args.batch_features)
     testDataLoader = DataLoader(test_set, batch_size=args.batch_size, shuffle=False, num_workers=0)
+    batch_feature = BatchFeature().to(args.device) if args.batch_features else None
     model.eval()
     with torch.no_grad():
         idx_loader, score_loader = [], []
         for i, (feat, labels) in enumerate(tqdm(testDataLoader)):
+            if batch_feature is not None:
+                feat = batch_feature(feat.to(args.device))
             if args.feat == "Raw":
                 feat = feat.to(args.device)
             else:
@@ -170,7 +183,8 @@ def test_on_VCC(feat_model_path, loss_model_path, part, add_loss):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = torch.load(feat_model_path)
     loss_model = torch.load(loss_model_path) if add_loss is not None else None
-    test_set_VCC = VCC2020("/data2/neil/VCC2020/", "LFCC", feat_len=args.feat_len)
+    test_set_VCC = VCC2020("/data2/neil/VCC2020/", "LFCC", feat_len=args.feat_len,
+                           use_store=args.use_feature_store)
     testDataLoader = DataLoader(test_set_VCC, batch_size=args.batch_size, shuffle=False, num_workers=0)
     model.eval()
     score_loader, idx_loader = [], []
@@ -230,7 +244,8 @@ def test_on_ASVspoof2015(feat_model_path, loss_model_path, part, add_loss):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = torch.load(feat_model_path)
     loss_model = torch.load(loss_model_path) if add_loss is not None else None
-    test_set_2015 = ASVspoof2015("/data2/neil/ASVspoof2015/", part="eval", feature="LFCC", feat_len=args.feat_len)
+    test_set_2015 = ASVspoof2015("/data2/neil/ASVspoof2015/", part="eval", feature="LFCC", feat_len=args.feat_len,
+                                 use_store=args.use_feature_store)
     testDataLoader = DataLoader(test_set_2015, batch_size=args.batch_size, shuffle=False, num_workers=0)
     model.eval()
     score_loader, idx_loader = [], []
@@ -13,6 +13,7 @@ from tqdm import tqdm
 from utils import str2bool, setup_seed
 import eval_metrics as em
 import yaml
+from clip_cache import SharedClipCache
 
 torch.set_default_tensor_type(torch.FloatTensor)
 
@@ -66,6 +67,28 @@ def initParams():
 
     parser.add_argument('--is_mixture', type=str2bool, nargs='?', const=True, default=False,
                         help="whether use mixture or vocals in training")
+    parser.add_argument('--use_shards', action='store_true',
+                        help="read the training set from tar shards (train/shards/) instead of single files")
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help="shuffle buffer size when reading shards")
+    parser.add_argument('--use_store', action='store_true',
+                        help="read the training set from the int16 memmap written by dataset/audio_store.py")
+    parser.add_argument('--use_feature_cache', action='store_true',
+                        help="crop the training features out of the float16 cache written by feature_cache.py")
+    parser.add_argument('--feature_cache', type=str, default=None,
+                        help="folder of the feature cache, <path_to_database>/train/features by default")
+    parser.add_argument('--crops_per_clip', type=int, default=1, help="training crops taken from every decoded clip")
+    parser.add_argument('--both_channels', action='store_true', help="use both channels of a training crop as examples")
+    parser.add_argument('--batch_features', action='store_true',
+                        help="load raw crops and compute the features per batch on the training device")
+    parser.add_argument('--codec_augment', type=float, default=0.0,
+                        help="probability of round-tripping a training crop through a random codec (see codec_augment.py)")
+    parser.add_argument('--codec_cache', type=str, default=None, help="folder caching the encoded crops across epochs")
+    parser.add_argument('--codec_cache_gb', type=float, default=4.0, help="size limit of the codec cache in GB")
+    parser.add_argument('--clip_cache_gb', type=float, default=0.0,
+                        help="keep the decoded dev/test clips in shared memory across epochs, up to this many GB")
+    parser.add_argument('--materialized_eval', action='store_true',
+                        help="validate and test on the fixed crops written by materialize_eval.py")
+    parser.add_argument('--eval_windows', type=int, default=1, help="crops per clip of the materialized dev/test sets")
     parser.add_argument('--test_on_eval', action='store_true',
                         help="whether to run EER on the evaluation set")
     parser.add_argument('--test_interval', type=int, default=5, help="test on eval for every how many epochs")
@@ -155,18 +178,69 @@ def train(args):
     feat_optimizer = torch.optim.Adam(feat_model.parameters(), lr=args.lr,
                                       betas=(args.beta_1, args.beta_2), eps=args.eps, weight_decay=0.0005)
 
-    training_set = Dataset_SingFake(os.path.join(args.path_to_database, "train"), args.is_mixture)
-    validation_set = Dataset_SingFake(os.path.join(args.path_to_database, "dev"), args.is_mixture)
-
-    trainDataLoader = DataLoader(training_set, batch_size=args.batch_size,
-                                 shuffle=True, num_workers=args.num_workers)
+    batch_feature = None
+    if args.batch_features:
+        assert not (args.use_store or args.use_shards or args.use_feature_cache), \
+            "--batch_features needs the flac training set"
+        batch_feature = BatchFeature().to(args.device)
+    if args.codec_augment > 0:
+        assert not (args.use_store or args.use_shards or args.use_feature_cache), \
+            "--codec_augment needs the flac training set"
+    if args.crops_per_clip > 1 or args.both_channels:
+        assert not (args.use_store or args.use_shards or args.use_feature_cache), \
+            "--crops_per_clip and --both_channels need the flac training set"
+
+    if args.use_feature_cache:
+        training_set = Dataset_SingFakeFeatures(os.path.join(args.path_to_database, "train"), args.is_mixture,
+                                                cache_dir=args.feature_cache)
+    elif args.use_store:
+        training_set = Dataset_SingFakeStore(os.path.join(args.path_to_database, "train"), args.is_mixture)
+    elif args.use_shards:
+        training_set = Dataset_SingFakeShards(os.path.join(args.path_to_database, "train"), args.is_mixture,
+                                              shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+    else:
+        codec_augment = None
+        if args.codec_augment > 0:
+            codec_augment = CodecAugment(p=args.codec_augment, cache_dir=args.codec_cache,
+                                         max_cache_bytes=int(args.codec_cache_gb * (1 << 30)))
+        training_set = Dataset_SingFake(os.path.join(args.path_to_database, "train"), args.is_mixture,
+                                        codec_augment=codec_augment, crops_per_clip=args.crops_per_clip,
+                                        both_channels=args.both_channels, raw_features=args.batch_features)
+    # validated (and tested) every epoch, the decoded clips can stay in shared memory
+    clip_cache = SharedClipCache(int(args.clip_cache_gb * (1 << 30))) if args.clip_cache_gb > 0 else None
+    if args.materialized_eval:
+        validation_set = Dataset_SingFakeEval(os.path.join(args.path_to_database, "dev"), args.is_mixture,
+                                              args.eval_windows, raw_features=args.batch_features)
+    else:
+        validation_set = Dataset_SingFake(os.path.join(args.path_to_database, "dev"), args.is_mixture,
+                                          raw_features=args.batch_features, clip_cache=clip_cache)
+
+    if getattr(training_set, "examples_per_clip", 1) > 1:
+        # every item holds several examples, batches still hold batch_size examples
+        trainDataLoader = DataLoader(training_set, num_workers=args.num_workers, collate_fn=flatten_collate,
+                                     batch_sampler=MultiCropBatchSampler(len(training_set), args.batch_size,
+                                                                         training_set.examples_per_clip))
+    else:
+        # shards are shuffled by the dataset itself
+        trainDataLoader = DataLoader(training_set, batch_size=args.batch_size,
+                                     shuffle=not args.use_shards, num_workers=args.num_workers)
+    # materialized sets are read in order, batch by batch
     valDataLoader = DataLoader(validation_set, batch_size=args.batch_size,
-                               shuffle=True, num_workers=args.num_workers)
+                               shuffle=not args.materialized_eval, num_workers=args.num_workers)
 
-    test_set = Dataset_SingFake(os.path.join(args.path_to_database, "test"), args.is_mixture)
+    if args.materialized_eval:
+        test_set = Dataset_SingFakeEval(os.path.join(args.path_to_database, "test"), args.is_mixture,
+                                        args.eval_windows, raw_features=args.batch_features)
+    else:
+        test_set = Dataset_SingFake(os.path.join(args.path_to_database, "test"), args.is_mixture,
+                                    raw_features=args.batch_features, clip_cache=clip_cache)
     testDataLoader = DataLoader(test_set, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
 
-    feat, _ = training_set[23]
+    feat, _ = next(iter(training_set)) if args.use_shards else training_set[23]
+    if getattr(training_set, "examples_per_clip", 1) > 1:
+        feat = feat[0]
+    if batch_feature is not None:
+        feat = batch_feature(feat.unsqueeze(0).to(args.device))[0]
     print("Feature shape", feat.shape)
 
     criterion = nn.CrossEntropyLoss().to(args.device)
@@ -215,11 +289,15 @@ def train(args):
         elif args.loss == "angulariso":
             adjust_learning_rate(args, args.lr, angulariso_optimizer, epoch_num)
         print('\nEpoch: %d ' % (epoch_num + 1))
+        if args.use_shards:
+            training_set.set_epoch(epoch_num)
         correct_m, total_m, correct_c, total_c, correct_v, total_v = 0, 0, 0, 0, 0, 0
 
         for i, (feat, labels) in enumerate(tqdm(trainDataLoader)):
             # if i > 2: break # debug purpose
             ## data prep
+            if batch_feature is not None:
+                feat = batch_feature(feat.to(args.device))
             if args.feat == "Raw":
                 feat = feat.to(args.device)
             else:
@@ -308,6 +386,8 @@ def train(args):
         with torch.no_grad():
             ip1_loader, tag_loader, idx_loader, score_loader = [], [], [], []
             for i, (feat, labels) in enumerate(tqdm(valDataLoader)):
+                if batch_feature is not None:
+                    feat = batch_feature(feat.to(args.device))
                 if args.feat == "Raw":
                     feat = feat.to(args.device)
                 else:
@@ -354,6 +434,8 @@ def train(args):
                             str(np.nanmean(devlossDict[monitor_loss])) + "\t" +
                             str(eer) +"\n")
             print("Val EER: {}".format(eer))
+            if clip_cache is not None:
+                print(clip_cache.info())
 
 
         if args.test_on_eval:
@@ -361,6 +443,8 @@ def train(args):
                 with torch.no_grad():
                     ip1_loader, tag_loader, idx_loader, score_loader = [], [], [], []
                     for i, (feat, labels) in enumerate(tqdm(testDataLoader)):
+                        if batch_feature is not None:
+                            feat = batch_feature(feat.to(args.device))
                         if args.feat == "Raw":
                             feat = feat.to(args.device)
                         else:
@@ -0,0 +1,127 @@
+import os
+import time
+import atexit
+import itertools
+import numpy as np
+from multiprocessing import Manager, resource_tracker, shared_memory
+
+
+class SharedClipCache:
+    """
+    Decoded clips in multiprocessing.shared_memory, for the dev/test sets that are decoded again at every
+    evaluation. Every clip is one float32 segment; the index (key -> segment name, shape, bytes, last use)
+    lives in a Manager process, so all DataLoader workers of this process, also those of later epochs,
+    read what the others decoded. The least recently used clips are evicted to stay under max_bytes, and
+    all segments are removed when the creating process exits.
+    """
+    def __init__(self, max_bytes=2 << 30):
+        self.max_bytes = max_bytes
+        # DataLoader workers must share the tracker of this process: one started by a worker would remove
+        # the segments when that worker exits at the end of the epoch
+        resource_tracker.ensure_running()
+        self._manager = Manager()
+        self.index = self._manager.dict()
+        self.stats = self._manager.dict(bytes=0, hits=0, misses=0)
+        self.lock = self._manager.Lock()
+        self.prefix = "clips_%d_%s" % (os.getpid(), os.urandom(4).hex())
+        self.owner = os.getpid()
+        self._names = itertools.count()
+        atexit.register(self.clear)
+
+    def __getstate__(self):
+        # the proxies pickle (spawned workers), the manager does not
+        state = self.__dict__.copy()
+        del state["_manager"], state["_names"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._names = itertools.count()
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        """
+        Returns a copy of the cached clip, or None.
+        """
+        entry = self.index.get(key)
+        shm = None
+        if entry is not None:
+            try:
+                shm = shared_memory.SharedMemory(name=entry[0])
+            except FileNotFoundError:
+                # evicted in the meantime
+                pass
+        with self.lock:
+            if shm is not None and key in self.index:
+                self.index[key] = entry[:3] + (time.monotonic(),)
+            self.stats["hits" if shm is not None else "misses"] += 1
+        if shm is None:
+            return None
+        try:
+            view = np.ndarray(entry[1], dtype=np.float32, buffer=shm.buf)
+            X = view.copy()
+            del view
+        finally:
+            shm.close()
+        return X
+
+    def put(self, key, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.nbytes == 0 or X.nbytes > self.max_bytes:
+            return
+        # the pid keeps names of different workers apart
+        name = "%s_%d_%d" % (self.prefix, os.getpid(), next(self._names))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=X.nbytes)
+        view = np.ndarray(X.shape, dtype=np.float32, buffer=shm.buf)
+        view[:] = X
+        del view
+        shm.close()
+        with self.lock:
+            if key in self.index:
+                # another worker decoded the same clip
+                _unlink(name)
+                return
+            self.index[key] = (name, X.shape, X.nbytes, time.monotonic())
+            self.stats["bytes"] += X.nbytes
+            if self.stats["bytes"] > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # called with the lock held; frees 10% more than needed, so not every put evicts
+        size = self.stats["bytes"]
+        for key, (name, _, nbytes, _) in sorted(self.index.items(), key=lambda item: item[1][3]):
+            if size <= 0.9 * self.max_bytes:
+                break
+            del self.index[key]
+            _unlink(name)
+            size -= nbytes
+        self.stats["bytes"] = size
+
+    def info(self):
+        stats = dict(self.stats)
+        lookups = max(stats["hits"] + stats["misses"], 1)
+        return "clip cache: %d clips, %.2f GB, %.1f%% hits" % (
+            len(self), stats["bytes"] / (1 << 30), 100.0 * stats["hits"] / lookups)
+
+    def clear(self):
+        if os.getpid() != self.owner:
+            return
+        try:
+            for name, _, _, _ in self.index.values():
+                _unlink(name)
+            self.index.clear()
+            self.stats["bytes"] = 0
+        except (OSError, EOFError):
+            # the manager is already gone at interpreter exit
+            pass
+
+
+def _unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
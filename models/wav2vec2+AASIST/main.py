@@ -22,7 +22,11 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from torchcontrib.optim import SWA
 from data_utils import (Dataset_ASVspoof2019_train,
-                        Dataset_ASVspoof2019_devNeval, genSpoof_list, Dataset_SingFake)
+                        Dataset_ASVspoof2019_devNeval, genSpoof_list, Dataset_SingFake,
+                        Dataset_SingFakeShards, Dataset_SingFakeStore, Dataset_SingFakeEval,
+                        MultiCropBatchSampler, flatten_collate, materialized_paths)
+from codec_augment import CodecAugment
+from clip_cache import SharedClipCache
 from evaluation import compute_eer
 from utils import create_optimizer, seed_worker, set_seed, str_to_bool
 from models.wav2vecAASIST import Wav2Vec2Model
@@ -127,6 +131,8 @@ def main(args: argparse.Namespace) -> None:
     # Training
     for epoch in range(config["num_epochs"]):
         print("Start training epoch{:03d}".format(epoch))
+        if isinstance(trn_loader.dataset, Dataset_SingFakeShards):
+            trn_loader.dataset.set_epoch(epoch)
         running_loss = train_epoch(trn_loader, model, optimizer, device,
                                    scheduler, config)
         
@@ -136,6 +142,8 @@ def main(args: argparse.Namespace) -> None:
         
         print("DONE.\nLoss:{:.5f}, train_eer: {:2f} %, dev_eer: {:.2f} %, additional_test_eer: {:.2f} %".format(
             running_loss, train_eer * 100, dev_eer * 100, additional_eer * 100))
+        if getattr(dev_loader.dataset, "clip_cache", None) is not None:
+            print(dev_loader.dataset.clip_cache.info())
         writer.add_scalar("loss", running_loss, epoch)
         writer.add_scalar("train_eer", train_eer, epoch)
         writer.add_scalar("dev_eer", dev_eer, epoch)
@@ -279,20 +287,71 @@ def get_singfake_loaders(seed: int, config: dict) -> List[torch.utils.data.DataL
     vocals_only = str_to_bool(config["vocals_only"])
     
     is_mixture = not vocals_only
+    # read the training set from tar shards (train/shards/) instead of single files
+    use_shards = str_to_bool(config.get("use_shards", "False"))
     
-    train_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "train"), is_mixture=is_mixture, target_sr=target_sr)
+    # or from the int16 memmap written by dataset/audio_store.py
+    use_store = str_to_bool(config.get("use_store", "False"))
+    
+    if float(config.get("codec_augment", 0.0)) > 0:
+        assert not (use_store or use_shards), "codec_augment needs the flac training set"
+    if int(config.get("crops_per_clip", 1)) > 1 or str_to_bool(config.get("both_channels", "False")):
+        assert not (use_store or use_shards), "crops_per_clip and both_channels need the flac training set"
+    if use_store:
+        train_set = Dataset_SingFakeStore(base_dir=os.path.join(base_dir, "train"), is_mixture=is_mixture, target_sr=target_sr)
+    elif use_shards:
+        train_set = Dataset_SingFakeShards(base_dir=os.path.join(base_dir, "train"), is_mixture=is_mixture, target_sr=target_sr,
+                                           shuffle_buffer=int(config.get("shuffle_buffer", 1000)), seed=seed)
+    else:
+        # round-trip training crops through a random codec with probability codec_augment, see codec_augment.py
+        codec_augment = None
+        if float(config.get("codec_augment", 0.0)) > 0:
+            codec_augment = CodecAugment(p=float(config["codec_augment"]), sr=int(target_sr),
+                                         cache_dir=config.get("codec_cache", None),
+                                         max_cache_bytes=int(float(config.get("codec_cache_gb", 4.0)) * (1 << 30)))
+        # several crops and/or both channels of every decoded clip
+        train_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "train"), is_mixture=is_mixture, target_sr=target_sr,
+                                     codec_augment=codec_augment, crops_per_clip=int(config.get("crops_per_clip", 1)),
+                                     both_channels=str_to_bool(config.get("both_channels", "False")))
     gen = torch.Generator()
     gen.manual_seed(seed)
-    trn_loader = DataLoader(train_set,
-                            batch_size=config["batch_size"],
-                            shuffle=True,
-                            drop_last=True,
-                            pin_memory=True,
-                            worker_init_fn=seed_worker,
-                            num_workers=4,
-                            generator=gen)
+    if getattr(train_set, "examples_per_clip", 1) > 1:
+        # every item holds several examples, batches still hold batch_size examples
+        trn_loader = DataLoader(train_set,
+                                batch_sampler=MultiCropBatchSampler(len(train_set), config["batch_size"],
+                                                                    train_set.examples_per_clip, drop_last=True,
+                                                                    generator=gen),
+                                collate_fn=flatten_collate,
+                                pin_memory=True,
+                                worker_init_fn=seed_worker,
+                                num_workers=4)
+    else:
+        trn_loader = DataLoader(train_set,
+                                batch_size=config["batch_size"],
+                                shuffle=not use_shards,
+                                drop_last=True,
+                                pin_memory=True,
+                                worker_init_fn=seed_worker,
+                                num_workers=4,
+                                generator=gen)
     
-    dev_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "dev"), is_mixture=is_mixture, target_sr=target_sr)
+    # dev, test and additional_test are evaluated again and again, keep their decoded clips in shared memory
+    clip_cache = None
+    if float(config.get("clip_cache_gb", 0)) > 0:
+        clip_cache = SharedClipCache(int(float(config["clip_cache_gb"]) * (1 << 30)))
+    # or evaluate on the fixed crops written by materialize_eval.py, for the splits that have them
+    materialized_eval = str_to_bool(config.get("materialized_eval", "False"))
+    eval_windows = int(config.get("eval_windows", 1))
+
+    def singfake_eval_set(split, clip_cache=None):
+        if materialized_eval:
+            if os.path.exists(materialized_paths(os.path.join(base_dir, split), is_mixture, "audio", eval_windows)[1]):
+                return Dataset_SingFakeEval(os.path.join(base_dir, split), is_mixture=is_mixture, windows=eval_windows)
+            print(f"{split} is not materialized (materialize_eval.py), decoding it instead")
+        return Dataset_SingFake(base_dir=os.path.join(base_dir, split), is_mixture=is_mixture, target_sr=target_sr,
+                                clip_cache=clip_cache)
+
+    dev_set = singfake_eval_set("dev", clip_cache)
     dev_loader = DataLoader(dev_set,
                             batch_size=config["batch_size"],
                             shuffle=False,
@@ -300,7 +359,7 @@ def get_singfake_loaders(seed: int, config: dict) -> List[torch.utils.data.DataL
                             num_workers=4,
                             pin_memory=True)
     
-    eval_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "test"), is_mixture=is_mixture, target_sr=target_sr)
+    eval_set = singfake_eval_set("test", clip_cache)
     eval_loader = DataLoader(eval_set,
                              batch_size=config["batch_size"],
                              shuffle=False,
@@ -308,7 +367,7 @@ def get_singfake_loaders(seed: int, config: dict) -> List[torch.utils.data.DataL
                              num_workers=4,
                              pin_memory=True)
     
-    additional_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "additional_test"), is_mixture=is_mixture, target_sr=target_sr)
+    additional_set = singfake_eval_set("additional_test", clip_cache)
     additional_loader = DataLoader(additional_set,
                                       batch_size=config["batch_size"],
                                       shuffle=False,
@@ -316,7 +375,7 @@ def get_singfake_loaders(seed: int, config: dict) -> List[torch.utils.data.DataL
                                       num_workers=4,
                                       pin_memory=True)
     
-    persian_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "persian_test"), is_mixture=is_mixture, target_sr=target_sr)
+    persian_set = singfake_eval_set("persian_test")
     persian_loader = DataLoader(persian_set,
                                 batch_size=config["batch_size"],
                                       shuffle=False,
@@ -324,28 +383,28 @@ def get_singfake_loaders(seed: int, config: dict) -> List[torch.utils.data.DataL
                                       num_workers=4,
                                       pin_memory=True)
     
-    mp3_test_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "codec_test", "mp3_128k"), is_mixture=is_mixture, target_sr=target_sr)
+    mp3_test_set = singfake_eval_set(os.path.join("codec_test", "mp3_128k"))
     mp3_loader = DataLoader(mp3_test_set,
                             batch_size=config["batch_size"],
                                       shuffle=False,
                                       drop_last=False,
                                       num_workers=4,
                                       pin_memory=True)
-    ogg_test_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "codec_test", "ogg_64k"), is_mixture=is_mixture, target_sr=target_sr)
+    ogg_test_set = singfake_eval_set(os.path.join("codec_test", "ogg_64k"))
     ogg_loader = DataLoader(ogg_test_set,
                             batch_size=config["batch_size"],
                                       shuffle=False,
                                       drop_last=False,
                                       num_workers=4,
                                       pin_memory=True)
-    aac_test_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "codec_test", "adts_64k"), is_mixture=is_mixture, target_sr=target_sr)
+    aac_test_set = singfake_eval_set(os.path.join("codec_test", "adts_64k"))
     aac_loader = DataLoader(aac_test_set,
                             batch_size=config["batch_size"],
                                       shuffle=False,
                                       drop_last=False,
                                       num_workers=4,
                                       pin_memory=True)
-    opus_test_set = Dataset_SingFake(base_dir=os.path.join(base_dir, "codec_test", "opus_64k"), is_mixture=is_mixture, target_sr=target_sr)
+    opus_test_set = singfake_eval_set(os.path.join("codec_test", "opus_64k"))
     opus_loader = DataLoader(opus_test_set,
                             batch_size=config["batch_size"],
                                       shuffle=False,